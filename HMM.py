@@ -35,10 +35,17 @@
 # To get started, just fill in code where indicated. Best of luck!
 
 import random
+import time
+import multiprocessing
 import numpy as np
 import string
-import pyphen
-import re
+
+from HMM_corpus import EncodedCorpus
+from HMM_lattice import SyllableLattice
+from HMM_profile import Stats
+from HMM_sampling import AliasTable, FittingTable
+from HMM_sparse import TopKEmissions, TopKFittingTable
+from HMM_syllables import SyllableIndex, clean_word, pyphen_syllables
 
 class HiddenMarkovModel:
     '''
@@ -62,7 +69,8 @@ class HiddenMarkovModel:
 
             O:          Observation matrix with dimensions L x D.
                         The (i, j)^th element is the probability of
-                        emitting observation j given state i.
+                        emitting observation j given state i. This may
+                        also be a sparse HMM_sparse.TopKEmissions.
 
         Parameters:
             L:          Number of states.
@@ -77,73 +85,229 @@ class HiddenMarkovModel:
                         is the probability of transitioning from the start
                         state to state i. For simplicity, we assume that
                         this distribution is uniform.
+
+            stats:      Optional HMM_profile.Stats that training and
+                        generation record counters and timers into. None
+                        (the default) records nothing.
+        '''
+
+        self.A = np.asarray(A, dtype=float)
+        self.O = _as_emissions(O)
+        self.L = len(self.A)
+        self.D = self.O.shape[1]
+        self.A_start = np.full(self.L, 1. / self.L)
+        self.stats = None
+
+        # Lazily built samplers and other values derived from A, O and
+        # A_start. Not pickled.
+        self._caches = {}
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_caches', None)
+        return state
+
+
+    def __setstate__(self, state):
+        self.stats = None
+        self.__dict__.update(state)
+        self._caches = {}
+
+
+    def _cached(self, name, source, build):
+        '''
+        Returns build(source), computed once and reused for as long as
+        source is the same object. Training replaces A and O with new
+        arrays, which invalidates everything derived from them. source may
+        also be a tuple of objects, all of which must be the same.
         '''
 
-        self.L = len(A)
-        self.D = len(O[0])
-        self.A = A
-        self.O = O
-        self.A_start = [1. / self.L for _ in range(self.L)]
+        entry = self._caches.get(name)
+
+        if entry is None or not _same_sources(entry[0], source):
+            entry = (source, build(source))
+            self._caches[name] = entry
+
+        return entry[1]
 
 
     def viterbi(self, x):
         '''
         Uses the Viterbi algorithm to find the max probability state 
-        sequence corresponding to a given input sequence.
+        sequence corresponding to a given input sequence. The recursion is
+        done in log space, so long sequences do not underflow.
 
         Arguments:
             x:          Input sequence in the form of a list of length M,
                         consisting of integers ranging from 0 to D - 1.
 
         Returns:
-            max_seq:    State sequence corresponding to x with the highest
+            max_seq:    Integer array of length M holding the state
+                        sequence corresponding to x with the highest
                         probability.
+
+            log_prob:   Log-probability of x jointly with max_seq.
+        '''
+
+        paths, log_probs = self.viterbi_batch([x])
+
+        return paths[0], log_probs[0]
+
+
+    def viterbi_batch(self, X, batch_size=4096):
+        '''
+        Runs the Viterbi algorithm on many sequences at once. Equal-length
+        sequences are decoded together, one vectorized argmax per time step.
+
+        Arguments:
+            X:          A dataset consisting of input sequences in the form
+                        of lists of variable length, consisting of integers
+                        ranging from 0 to D - 1. In other words, a list of
+                        lists, or an HMM_corpus.EncodedCorpus.
+
+            batch_size: Maximum number of sequences decoded together.
+
+        Returns:
+            max_seqs:   List of integer arrays, the most likely state
+                        sequence for each element of X.
+
+            log_probs:  Array of the log-probability of each sequence
+                        jointly with its decoded state sequence.
+        '''
+
+        with np.errstate(divide='ignore'):
+            log_A = np.log(np.asarray(self.A))
+            log_start = np.log(np.asarray(self.A_start))
+
+        max_seqs = [np.zeros(0, dtype=int) for _ in range(len(X))]
+        log_probs = np.zeros(len(X))
+
+        # Decode sequences grouped by length, remembering where each row
+        # came from.
+        lengths = _lengths(X)
+        for M in np.unique(lengths[lengths > 0]):
+            rows = np.flatnonzero(lengths == M)
+
+            for i in range(0, len(rows), batch_size):
+                idx = rows[i:i + batch_size]
+                batch = _gather(X, idx, M)
+                with np.errstate(divide='ignore'):
+                    log_Ox = np.log(_emission_columns(self.O, batch))
+
+                paths, probs = _viterbi_decode(log_A, log_Ox, log_start)
+
+                for r, path, prob in zip(idx, paths, probs):
+                    max_seqs[r] = path
+                    log_probs[r] = prob
+
+        return max_seqs, log_probs
+
+
+    def forward_scaled(self, x):
+        '''
+        Runs the forward algorithm with every alpha vector rescaled to sum
+        to one. Each time step is a single vector-matrix product against A,
+        so this is the engine behind forward() and unsupervised learning.
+
+        Arguments:
+            x:          Input sequence in the form of a list of length M,
+                        consisting of integers ranging from 0 to D - 1.
+
+        Returns:
+            alphas:     Array of shape (M + 1, L). Row i is alpha(i)
+                        divided by the probability of the prefix x^1:i,
+                        i.e. the posterior P(y^i = j | x^1:i). Row 0 is
+                        unused and left as zeros.
+
+            scales:     Array of length M + 1. The i^th element is the
+                        sum of the unscaled alpha(i) after the previous
+                        rows were rescaled, i.e. P(x^i | x^1:i-1). The
+                        log-probability of x is sum(log(scales[1:])).
         '''
 
-        M = len(x)      # Length of sequence.
+        A = np.asarray(self.A)
+        A_start = np.asarray(self.A_start)
+
+        M = len(x)
+        alphas = np.zeros((M + 1, self.L))
+        scales = np.ones(M + 1)
+
+        # Gather the emission probability columns for x once; row i is
+        # O[:, x^i+1].
+        Ox = _emission_columns(self.O, x).T
+
+        alpha = A_start * Ox[0]
+
+        for i in range(1, M + 1):
+            if i > 1:
+                alpha = alphas[i - 1].dot(A) * Ox[i - 1]
+
+            total = alpha.sum()
+            scales[i] = total
+
+            if total != 0:
+                alpha = alpha / total
+
+            alphas[i] = alpha
+
+        return alphas, scales
+
 
-        # The (i, j)^th elements of probs and seqs are the max probability
-        # of the prefix of length i ending in state j and the prefix
-        # that gives this probability, respectively.
-        #
-        # For instance, probs[1][0] is the probability of the prefix of
-        # length 1 ending in state 0.
-        probs = [[0. for _ in range(self.L)] for _ in range(M + 1)]
-        seqs = [['' for _ in range(self.L)] for _ in range(M + 1)]
+    def backward_scaled(self, x, scales=None):
+        '''
+        Runs the backward algorithm with every beta vector rescaled. Each
+        time step is a single matrix-vector product against A.
 
-        for i in range(self.L):
-            probs[1][i] = self.A_start[i] * self.O[i][x[0]]
+        Arguments:
+            x:          Input sequence in the form of a list of length M,
+                        consisting of integers ranging from 0 to D - 1.
 
-        for j in range(2, M+1):
-            for i in range(self.L):
+            scales:     Optional scaling factors returned by
+                        forward_scaled(x). When given, beta(i) is divided
+                        by the same factors as the alphas, so that
+                        alphas[i] * betas[i] is exactly the posterior of
+                        y^i. When omitted, each beta vector is normalized
+                        to sum to one.
 
-                max_value = 0
-                max_i = 0
+        Returns:
+            betas:      Array of shape (M + 1, L) of rescaled betas. Row 0
+                        is unused and left as zeros.
 
-                for k in range(self.L):
-                    if probs[j-1][k] * self.A[k][i] * self.O[i][x[j-1]] >= max_value:
-                        max_value = probs[j-1][k] * self.A[k][i] * self.O[i][x[j-1]]
-                        max_i = k
+            scales:     Array of length M + 1 of the factors used. The
+                        unscaled beta(i) is betas[i] * prod(scales[i+1:])
+                        when the forward factors were given, and
+                        betas[i] * prod(scales[i:M]) otherwise.
+        '''
 
-                probs[j][i] = max_value
-                seqs[j][i] = max_i
+        A = np.asarray(self.A)
 
-        max_value = 0
-        max_i = 0
+        M = len(x)
+        betas = np.zeros((M + 1, self.L))
+        own_scales = scales is None
 
-        for k in range(self.L):
-            if (probs[M][k] > max_value):
-                max_value = probs[M][k]
-                max_i = k
+        if own_scales:
+            scales = np.ones(M + 1)
 
-        s = str(max_i)
+        Ox = _emission_columns(self.O, x).T
 
-        for i in range(M + 1, 1, -1):
-            s += str(seqs[i - 1][int(s[len(s) - 1])])
+        betas[M] = 1.
 
-        max_seq = s[::-1]
+        for i in range(M - 1, 0, -1):
+            beta = A.dot(Ox[i] * betas[i + 1])
 
-        return max_seq
+            if own_scales:
+                scales[i] = beta.sum()
+                total = scales[i]
+            else:
+                total = scales[i + 1]
+
+            if total != 0:
+                beta = beta / total
+
+            betas[i] = beta
+
+        return betas, scales
 
 
     def forward(self, x, normalize=False):
@@ -160,7 +324,7 @@ class HiddenMarkovModel:
                         unsupervised learning.
 
         Returns:
-            alphas:     Vector of alphas.
+            alphas:     Array of alphas with shape (M + 1, L).
 
                         The (i, j)^th element of alphas is alpha_j(i),
                         i.e. the probability of observing prefix x^1:i
@@ -171,28 +335,14 @@ class HiddenMarkovModel:
                         given that y^1 = 0, i.e. the first state is 0.
         '''
 
-        M = len(x)
-        alphas = [[0. for _ in range(self.L)] for _ in range(M + 1)]
-
-        for i in range(self.L):
-            alphas[1][i] = self.A_start[i] * self.O[i][x[0]]
-
-        for i in range(1, M):
-            for z in range(self.L):
-                alphas[i+1][z] = 0
-
-                for j in range(self.L):
-                    alphas[i+1][z] += alphas[i][j] * self.A[j][z]
-
-                alphas[i+1][z] *= self.O[z][x[(i+1)-1]]
+        alphas, scales = self.forward_scaled(x)
 
-            if normalize:
-                total = sum(alphas[i+1])
+        if normalize:
+            return alphas
 
-                if total != 0:
-                    alphas[i+1] = np.divide(alphas[i+1], total)
-
-        return alphas
+        # Undo the scaling. This underflows for long sequences exactly as
+        # the unscaled recursion would.
+        return alphas * np.cumprod(scales)[:, None]
 
 
     def backward(self, x, normalize=False):
@@ -209,7 +359,7 @@ class HiddenMarkovModel:
                         unsupervised learning.
 
         Returns:
-            betas:      Vector of betas.
+            betas:      Array of betas with shape (M + 1, L).
 
                         The (i, j)^th element of betas is beta_j(i), i.e.
                         the probability of observing prefix x^(i+1):M and
@@ -220,29 +370,67 @@ class HiddenMarkovModel:
                         given that y^M = 0, i.e. the last state is 0.
         '''
 
-        M = len(x)      # Length of sequence.
-        betas = [[0. for _ in range(self.L)] for _ in range(M + 1)]
+        betas, scales = self.backward_scaled(x)
 
-        for i in range(self.L):
-            betas[M][i] = 1.0
+        if normalize:
+            return betas
 
-        for i in range(M - 1, 0, -1):
-            for z in range(self.L):
-                betas[i][z] = 0
+        # beta(i) was divided by scales[i], ..., scales[M - 1].
+        return betas * np.cumprod(scales[::-1])[::-1][:, None]
+
+
+    def log_probability(self, x):
+        '''
+        Finds the log-probability of a given input sequence using the
+        scaled forward algorithm. Unlike probability_alphas, this does not
+        underflow for long sequences.
+
+        Arguments:
+            x:          Input sequence in the form of a list of length M,
+                        consisting of integers ranging from 0 to D - 1.
+
+        Returns:
+            log_prob:   Natural log of the total probability that x can
+                        occur, or -inf if it cannot.
+        '''
+
+        _, scales = self.forward_scaled(x)
+
+        with np.errstate(divide='ignore'):
+            return np.sum(np.log(scales[1:]))
+
+
+    def score(self, X, batch_size=4096):
+        '''
+        Finds the total log-likelihood of a dataset, scoring equal-length
+        sequences together with the batched forward algorithm.
+
+        Arguments:
+            X:          A dataset consisting of input sequences in the form
+                        of lists of variable length, or an
+                        HMM_corpus.EncodedCorpus.
+
+            batch_size: Maximum number of sequences scored together.
+
+        Returns:
+            log_prob:   Sum of the log-probabilities of the sequences.
+        '''
 
-                for j in range(self.L):
-                    betas[i][z] += betas[i + 1][j] * self.A[z][j] * self.O[j][x[(i+1)-1]]
+        A = np.asarray(self.A)
+        A_start = np.asarray(self.A_start)
+        log_prob = 0.
 
-            if normalize:
-                total = sum(betas[i])
+        for batch in _length_buckets(X, batch_size):
+            Ox = _emission_columns(self.O, batch).transpose(1, 2, 0)
+            _, scales = _forward_batch(A, A_start, Ox)
 
-                if total != 0:
-                    betas[i] = np.divide(betas[i], total)
+            with np.errstate(divide='ignore'):
+                log_prob += np.sum(np.log(scales))
 
-        return betas
+        return float(log_prob)
 
 
-    def supervised_learning(self, X, Y):
+    def supervised_learning(self, X, Y, pseudocount=0.):
         '''
         Trains the HMM using the Maximum Likelihood closed form solutions
         for the transition and observation matrices on a labeled
@@ -253,117 +441,314 @@ class HiddenMarkovModel:
             X:          A dataset consisting of input sequences in the form
                         of lists of variable length, consisting of integers 
                         ranging from 0 to D - 1. In other words, a list of
-                        lists.
+                        lists, or an HMM_corpus.EncodedCorpus.
 
             Y:          A dataset consisting of state sequences in the form
                         of lists of variable length, consisting of integers 
                         ranging from 0 to L - 1. In other words, a list of
-                        lists.
+                        lists, or an HMM_corpus.EncodedCorpus.
 
                         Note that the elements in X line up with those in Y.
+
+            pseudocount: Count added to every transition and emission
+                        before normalizing (additive smoothing). With 0,
+                        rows of states that never occur are left as zeros.
         '''
 
-        # Calculate each element of A using the M-step formulas.
+        if not isinstance(X, EncodedCorpus):
+            X = EncodedCorpus.from_sequences(X)
+        if not isinstance(Y, EncodedCorpus):
+            Y = EncodedCorpus.from_sequences(Y)
 
-        for b in range(len(self.A)):
-            for a in range(len(self.A[b])):
+        x = np.asarray(X.tokens, dtype=np.intp)
+        y = np.asarray(Y.tokens, dtype=np.intp)
 
-                numerator = 0
-                denominator = 0
+        # Every position except the last of each sequence has a successor.
+        has_next = np.ones(len(y), dtype=bool)
+        has_next[Y.offsets[1:][Y.lengths > 0] - 1] = False
+        before = np.flatnonzero(has_next)
 
-                for j in range(len(Y)):
-                    for i in range(len(Y[j]) - 1):
+        # Count transitions and emissions in a single pass each.
+        A_num = np.bincount(y[before] * self.L + y[before + 1],
+                            minlength=self.L * self.L).reshape(self.L, self.L)
+        O_num = np.bincount(y * self.D + x,
+                            minlength=self.L * self.D).reshape(self.L, self.D)
 
-                        if Y[j][i + 1] == a and Y[j][i] == b:
-                            numerator += 1
-                        if Y[j][i] == b:
-                            denominator += 1
+        A_num = A_num + pseudocount
+        O_num = O_num + pseudocount
 
-                if denominator != 0:
-                    self.A[b][a] = numerator / denominator
-                else:
-                    self.A[b][a] = 0
+        # Calculate A and O using the M-step formulas.
+        A_denom = A_num.sum(axis=1, keepdims=True)
+        O_denom = O_num.sum(axis=1, keepdims=True)
+
+        self.A = np.divide(A_num, A_denom, out=np.zeros((self.L, self.L)),
+                           where=A_denom != 0)
+        self.O = np.divide(O_num, O_denom, out=np.zeros((self.L, self.D)),
+                           where=O_denom != 0)
+
+
+    def unsupervised_learning(self, X, N_iters, tol=None, batch_size=4096,
+                              n_jobs=None):
+        '''
+        Trains the HMM using the Baum-Welch algorithm on an unlabeled
+        datset X. The attributes of the HMM object are updated in place,
+        and the training history is also stored in self.history.
+
+        Arguments:
+            X:          A dataset consisting of input sequences in the form
+                        of lists of length M, consisting of integers ranging
+                        from 0 to D - 1. In other words, a list of lists,
+                        or an HMM_corpus.EncodedCorpus.
+
+            N_iters:    The maximum number of iterations to train on.
 
-        # Calculate each element of O using the M-step formulas.
+            tol:        Stop once the relative improvement in
+                        log-likelihood between two iterations drops below
+                        tol. None always runs N_iters iterations.
 
-        for z in range(len(self.O)):
-            for w in range(len(self.O[z])):
+            batch_size: Maximum number of equal-length sequences whose
+                        E-step is computed together.
+
+            n_jobs:     Number of worker processes for the E-step. Each
+                        worker receives its shard of X once and only the
+                        current A and O on every iteration. None or 1
+                        trains in this process.
+
+        Returns:
+            history:    List with one dictionary per iteration, holding
+                        the log-likelihood of X before the update
+                        ('log_likelihood') and the wall time in seconds of
+                        the iteration ('time'), its E-step ('e_step_time')
+                        and its M-step ('m_step_time').
+        '''
 
-                numerator = 0
-                denominator = 0
+        # Training works on a dense observation matrix.
+        self.O = _dense(self.O)
 
-                for j in range(len(Y)):
-                    for i in range(len(Y[j])):
+        # Group the sequences by length once; every iteration reuses the
+        # same batches.
+        buckets = _length_buckets(X, batch_size)
 
-                        if X[j][i] == w and Y[j][i] == z:
-                            numerator += 1
-                        if Y[j][i] == z:
-                            denominator += 1
+        pool = None
+        history = []
 
-                if denominator != 0:
-                    self.O[z][w] = numerator / denominator
+        if n_jobs is not None and n_jobs > 1:
+            shards = _shard_buckets(buckets, n_jobs)
+            pool = multiprocessing.Pool(len(shards), _init_worker, (shards,))
+
+        try:
+            for epoch in range(N_iters):
+                start = time.perf_counter()
+
+                if pool is None:
+                    stats = _expected_statistics(self.A, self.O, self.A_start,
+                                                 buckets, self.stats)
                 else:
-                    self.O[z][w] = 0
+                    params = (np.asarray(self.A), np.asarray(self.O),
+                              np.asarray(self.A_start))
+                    timed = self.stats is not None
+                    results = pool.map(_worker_statistics,
+                                       [(i, params, timed)
+                                        for i in range(len(shards))])
+
+                    if timed:
+                        for _, worker_stats in results:
+                            self.stats.merge(worker_stats)
+                        results = [result for result, _ in results]
+
+                    stats = _reduce_statistics(results)
+
+                A_num, O_num, A_denom, O_denom, log_prob = stats
+                e_step = time.perf_counter()
+
+                self.A = np.divide(A_num, A_denom)
+                self.O = np.divide(O_num, O_denom)
+                end = time.perf_counter()
+
+                if self.stats is not None:
+                    self.stats.count('em_iterations')
+                    self.stats.add_time('em_m_step', end - e_step)
+
+                history.append({
+                    'log_likelihood': float(log_prob),
+                    'time': end - start,
+                    'e_step_time': e_step - start,
+                    'm_step_time': end - e_step,
+                })
 
+                if tol is not None and len(history) > 1:
+                    previous = history[-2]['log_likelihood']
 
-    def unsupervised_learning(self, X, N_iters):
+                    if abs(log_prob - previous) <= tol * abs(previous):
+                        break
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        self.history = history
+
+        # Keep the expected statistics of the last iteration, per sequence,
+        # so that online learning can later blend new data into them.
+        n_seqs = sum(len(batch) for batch in buckets)
+        if history and n_seqs > 0:
+            self._online_stats = _per_sequence(stats[:4], n_seqs)
+            self._online_steps = 0
+
+        return history
+
+
+    def extend_vocabulary(self, n_new, new_mass=None):
         '''
-        Trains the HMM using the Baum-Welch algorithm on an unlabeled
-        datset X. Note that this method does not return anything, but
-        instead updates the attributes of the HMM object.
+        Adds n_new observations to the model. Every state gives the new
+        observations new_mass of its emission probability in total, split
+        evenly, and the other columns of O are scaled down to make room.
+        Running online statistics get zero counts for the new observations.
 
         Arguments:
-            X:          A dataset consisting of input sequences in the form
-                        of lists of length M, consisting of integers ranging
-                        from 0 to D - 1. In other words, a list of lists.
+            n_new:      Number of observations to add.
+
+            new_mass:   Total probability of the new observations in every
+                        state. Defaults to n_new / (D + n_new), as if they
+                        were as likely as the average observation.
+        '''
+
+        if n_new <= 0:
+            return
+
+        D = self.D + n_new
+
+        if new_mass is None:
+            new_mass = n_new / D
+
+        O = _dense(self.O) * (1. - new_mass)
+        self.O = np.hstack([O, np.full((self.L, n_new), new_mass / n_new)])
+        self.D = D
+
+        stats = getattr(self, '_online_stats', None)
+        if stats is not None:
+            A_num, O_num, A_denom, O_denom = stats
+            O_num = np.hstack([O_num, np.zeros((self.L, n_new))])
+            self._online_stats = (A_num, O_num, A_denom, O_denom)
+
+
+    def partial_fit(self, X, decay=0.7, offset=2., batch_size=4096,
+                    prior_steps=10):
+        '''
+        Runs one step of stepwise online EM on a mini-batch. The expected
+        sufficient statistics of X, per sequence, are blended into running
+        totals with step size (steps + offset)^-decay, and A and O are
+        re-estimated from the totals. Observations beyond the current
+        vocabulary are added with extend_vocabulary first.
+
+        unsupervised_learning leaves running totals behind. Any other model,
+        e.g. one unpickled or opened with HMM_io.load_model, which do not
+        store them, starts from totals that reproduce its current A and O,
+        counted as prior_steps earlier steps.
+
+        Arguments:
+            X:          A mini-batch of input sequences, as a list of lists
+                        or an HMM_corpus.EncodedCorpus.
+
+            decay:      Exponent of the step size, in (0.5, 1]. Smaller
+                        values forget old data faster.
 
-            N_iters:    The number of iterations to train on.
+            offset:     Offset of the step size. Larger values make the
+                        first steps smaller.
+
+            batch_size: Maximum number of equal-length sequences whose
+                        E-step is computed together.
+
+            prior_steps: Weight of the current parameters when there are no
+                        running totals, in steps. The first update then
+                        has step size (prior_steps + offset)^-decay.
+
+        Returns:
+            log_prob:   Log-likelihood of X before the update.
         '''
 
-        for epoch in range(N_iters):
+        buckets = _length_buckets(X, batch_size)
+        n_seqs = sum(len(batch) for batch in buckets)
+
+        if n_seqs == 0:
+            return 0.
+
+        top = max(int(batch.max()) for batch in buckets)
+        self.extend_vocabulary(top + 1 - self.D)
+        self.O = _dense(self.O)
+
+        stats = _expected_statistics(self.A, self.O, self.A_start, buckets,
+                                     self.stats)
+        batch_stats = _per_sequence(stats[:4], n_seqs)
+
+        running = getattr(self, '_online_stats', None)
+        steps = getattr(self, '_online_steps', 0)
 
-            A_num = np.zeros((self.L, self.L))
-            O_num = np.zeros((self.L, self.D))
-            A_denom = np.zeros((self.L, 1))
-            O_denom = np.zeros((self.L, 1))
+        if running is None:
+            # Totals whose M-step gives back the current A and O, with the
+            # state occupancy of this batch.
+            _, _, A_denom, O_denom = batch_stats
+            running = (self.A * A_denom, self.O * O_denom, A_denom, O_denom)
+            steps = prior_steps
 
-            for p in X:
-                M = len(p)
+        eta = (steps + offset) ** -decay
+        running = tuple((1. - eta) * old + eta * new
+                        for old, new in zip(running, batch_stats))
 
-                alphas = self.forward(p, normalize=True)
-                betas = self.backward(p, normalize=True)
+        self._online_stats = running
+        self._online_steps = steps + 1
 
-                for i in range(1, M + 1):
+        # States without expected visits keep their rows.
+        A_num, O_num, A_denom, O_denom = running
+        self.A = np.divide(A_num, A_denom, out=np.array(self.A, dtype=float),
+                           where=A_denom != 0)
+        self.O = np.divide(O_num, O_denom, out=np.array(self.O, dtype=float),
+                           where=O_denom != 0)
 
-                    total = np.zeros((self.L, 1))
+        return float(stats[4])
 
-                    for j in range(self.L):
-                        total[j] = alphas[i][j] * betas[i][j]
 
-                    total = np.divide(total, sum(total))
+    def online_learning(self, batches, n_epochs=1, decay=0.7, offset=2.,
+                        prior_steps=10):
+        '''
+        Trains the HMM with stepwise online EM over a sequence of
+        mini-batches, e.g. to absorb a new corpus into a trained model
+        without retraining from scratch.
+
+        Arguments:
+            batches:    List of mini-batches, each a list of lists or an
+                        HMM_corpus.EncodedCorpus.
+
+            n_epochs:   Number of passes over the mini-batches.
 
-                    for k in range(self.L):
-                        O_num[k][p[i - 1]] += total[k]
-                        O_denom[k] += total[k]
+            decay:      Exponent of the step size; see partial_fit.
 
-                        if i != M:
-                            A_denom[k] += total[k]
+            offset:     Offset of the step size; see partial_fit.
 
-                for i in range(1, M):
-                    diff = np.zeros((self.L, self.L))
+            prior_steps: Weight of the current parameters of a model without
+                        running totals; see partial_fit.
 
-                    for j in range(self.L):
-                        for k in range(self.L):
-                            diff[j][k] = alphas[i][j] * self.A[j][k] * self.O[k][p[i]] * betas[i + 1][k]
+        Returns:
+            history:    List with one dictionary per mini-batch, holding its
+                        log-likelihood before the update
+                        ('log_likelihood') and the wall time of the update
+                        in seconds ('time').
+        '''
 
-                    diff = np.divide(diff, np.sum(diff))
+        history = []
 
-                    for a in range(self.L):
-                        for b in range(self.L):
-                            A_num[a][b] += diff[a][b]
+        for epoch in range(n_epochs):
+            for batch in batches:
+                start = time.perf_counter()
+                log_prob = self.partial_fit(batch, decay, offset,
+                                            prior_steps=prior_steps)
 
-            self.A = np.divide(A_num, A_denom)
-            self.O = np.divide(O_num, O_denom)
+                history.append({
+                    'log_likelihood': log_prob,
+                    'time': time.perf_counter() - start,
+                })
+
+        return history
 
 
     def generate_emission(self, M):
@@ -383,16 +768,52 @@ class HiddenMarkovModel:
         emission = []
         states = []
 
-        state = np.random.choice(list(range(self.L)))
+        state = self.sample_start()
 
         for i in range(M):
-            state = np.random.choice(list(range(self.L)), p=self.A[state])
-            emission.append(np.random.choice(list(range(self.D)), p=self.O[state]))
+            state = self.sample_transition(state)
+            emission.append(self.sample_emission(state))
 
             states.append(state)
 
         return emission, states
 
+    def sample_start(self):
+        '''
+        Draws a state from the starting transition probabilities.
+        '''
+
+        table = self._cached('A_start', self.A_start, AliasTable)
+        return table.sample()
+
+    def sample_transition(self, state):
+        '''
+        Draws the state following the given state.
+        '''
+
+        if self.stats is not None:
+            self.stats.count('transition_draws')
+
+        table = self._cached('A', self.A, AliasTable)
+        return table.sample(state)
+
+    def sample_emission(self, state):
+        '''
+        Draws one observation from the given state.
+
+        Arguments:
+            state:      State to emit from.
+
+        Returns:
+            choice:     The sampled observation.
+        '''
+
+        if isinstance(self.O, TopKEmissions):
+            return self.O.sample(state)
+
+        table = self._cached('O', self.O, AliasTable)
+        return table.sample(state)
+
     ################################################################################
     # CHANGES MADE: ADDED UNIQUE EMISSION FUNCTIONS SPECIFICALLY FOR SONNET GENERATION
     ################################################################################
@@ -400,14 +821,15 @@ class HiddenMarkovModel:
     def get_syllables(self, word, syl_dict, rem_num_syl):
 
 
-        word = re.sub('^[^a-zA-Z]*|[^a-zA-Z]*$', '', word)
+        word = clean_word(word)
+
+        if (word not in syl_dict):
+            if self.stats is not None:
+                self.stats.count('pyphen_fallbacks')
 
-        if (word.lower() not in syl_dict):
-            dic = pyphen.Pyphen(lang='en')
-            syl = dic.inserted(word.lower()).split('-')
-            return len(syl)
+            return pyphen_syllables(word)
 
-        normal, end = syl_dict[word.lower()]
+        normal, end = syl_dict[word]
 
         for idx in range(len(normal)):
             if normal[idx] <= rem_num_syl:
@@ -419,9 +841,175 @@ class HiddenMarkovModel:
                     return end[idx]
 
         return -1
+
+    def _syllable_counts(self, inv_obs_map, syl_dict, rem_num_syl):
+        '''
+        Returns an integer array of length D whose w^th element is
+        get_syllables(inv_obs_map[w], syl_dict, rem_num_syl) if the word
+        fits in the remaining syllables, and -1 otherwise. syl_dict may be
+        a raw syllable dictionary, which is compiled into a SyllableIndex
+        once, or a SyllableIndex itself.
+        '''
+
+        index = self._syllable_index(inv_obs_map, syl_dict)
+        return index.counts(rem_num_syl)
+
+    def _syllable_index(self, inv_obs_map, syl_dict):
+        '''
+        Returns syl_dict if it is a SyllableIndex, and otherwise the
+        SyllableIndex compiled from it once for this model.
+        '''
+
+        if isinstance(syl_dict, SyllableIndex):
+            return syl_dict
+
+        return self._cached(
+            'syllable_index', (inv_obs_map, syl_dict),
+            lambda src: SyllableIndex.from_dictionary(
+                inv_obs_map, syl_dict, self.D, self.stats))
+
+    def syllable_lattice(self, inv_obs_map, syl_dict, M=10):
+        '''
+        Returns the HMM_lattice.SyllableLattice of this model for lines of
+        up to M syllables. It is built once and reused until A, O or the
+        syllable data change, or a longer line is requested.
+        '''
+
+        index = self._syllable_index(inv_obs_map, syl_dict)
+        sources = (self.A, self.O, self.A_start, index)
+
+        entry = self._caches.get('lattice')
+
+        if entry is not None and _same_sources(entry[0], sources) \
+                and entry[1].R >= M:
+            return entry[1]
+
+        lattice = SyllableLattice(self.A, _dense(self.O), self.A_start,
+                                  index, M)
+        self._caches['lattice'] = (sources, lattice)
+
+        return lattice
+
+    def generate_exact_emission(self, M, inv_obs_map, syl_dict,
+                                seed_word_idx=None):
+        '''
+        Generates a line of exactly M syllables from the distribution of the
+        model conditioned on the line length, instead of enforcing the meter
+        word by word as generate_sonnet_emission does. The first call builds
+        a lattice over (state, syllables remaining); later lines cost
+        O(words * L).
+
+        Arguments:
+            M:              Number of syllables of the line, e.g. 10 for
+                            sonnets or 5 and 7 for haiku.
+
+            inv_obs_map:    Dictionary from observation index to word.
+
+            syl_dict:       Syllable dictionary, or a SyllableIndex.
+
+            seed_word_idx:  Optional observation forced as the first word,
+                            as in generate_sonnet_rhyme_emission.
+
+        Returns:
+            emission:       The generated observations as a list.
+
+            states:         The generated states as a list.
+        '''
+
+        lattice = self.syllable_lattice(inv_obs_map, syl_dict, M)
+        return lattice.sample(M, seed_word_idx)
+
+    def generate_lines(self, N, M, inv_obs_map, syl_dict, seed_word_idxs=None,
+                       rng=None):
+        '''
+        Generates N lines of exactly M syllables at once, advancing all of
+        them in lockstep with vectorized transitions and emissions. Each
+        line is drawn from the same distribution as generate_exact_emission.
+
+        Arguments:
+            N:              Number of lines.
+
+            M:              Number of syllables of every line.
+
+            inv_obs_map:    Dictionary from observation index to word.
+
+            syl_dict:       Syllable dictionary, or a SyllableIndex.
+
+            seed_word_idxs: Optional list of N observations forced as the
+                            first word of each line, e.g. rhyming end words
+                            for a model trained on reversed lines.
+
+            rng:            A numpy Generator, or a seed for one. Line i
+                            uses row i of a block of uniform numbers drawn
+                            from it, so the same seed and N reproduce the
+                            same lines.
+
+        Returns:
+            emissions:      List of N emissions, each a list.
+
+            states:         List of N state sequences, each a list.
+        '''
+
+        if seed_word_idxs is not None and len(seed_word_idxs) != N:
+            raise ValueError('Expected %d seed words, got %d.'
+                             % (N, len(seed_word_idxs)))
+
+        rng = np.random.default_rng(rng)
+        lattice = self.syllable_lattice(inv_obs_map, syl_dict, M)
+
+        start = time.perf_counter()
+        uniforms = rng.random((N, 2 + 3 * M))
+        emissions, states, lengths = lattice.sample_batch(
+            M, uniforms, seed_word_idxs)
+
+        if self.stats is not None:
+            self.stats.add_time('generate_lines', time.perf_counter() - start)
+            self.stats.count('lines', N)
+            self.stats.count('words', int(lengths.sum()))
+
+        return ([list(e[:n]) for e, n in zip(emissions.tolist(), lengths)],
+                [list(s[:n]) for s, n in zip(states.tolist(), lengths)])
+
+    def _sample_fitting(self, state, inv_obs_map, syl_dict, rem_num_syl):
+        '''
+        Draws an observation from O[state] restricted to the words that fit
+        in rem_num_syl syllables, without rejection sampling. One table,
+        built once, serves every remaining-syllable count.
+
+        Returns:
+            choice:     The sampled observation.
+
+            s_count:    Its number of syllables.
+        '''
+
+        index = self._syllable_index(inv_obs_map, syl_dict)
+        table = self._cached('O_fitting', (self.O, index),
+                             lambda src: _fitting_table(self.O, index))
+
+        choice = table.sample(state, rem_num_syl)
+
+        if self.stats is not None:
+            self.stats.count('emission_draws')
+
+        if choice == -1:
+            if self.stats is not None:
+                self.stats.count('fitting_fallbacks')
+
+            # No word of this state fits; fall back to the fitting words
+            # weighted by their total emission mass.
+            fallback = self._cached(
+                'O_fitting_any', (self.O, index),
+                lambda src: FittingTable(_column_sums(self.O), index))
+            choice = fallback.sample(0, rem_num_syl)
+
+        if choice == -1:
+            raise ValueError('No word fits in %d syllables.' % rem_num_syl)
+
+        return choice, int(index.counts(rem_num_syl)[choice])
     
     # given a number of syllables, a inverted obs map (obx idx to word), and a syllable dictionary),
-    # return indices corresponding to a sonnet
+    # return indices corresponding to a sonnet. syl_dict may also be an HMM_syllables.SyllableIndex
+    # built for the same observations.
     def generate_sonnet_emission(self, M, inv_obs_map, syl_dict):
 
         emission = []
@@ -429,42 +1017,72 @@ class HiddenMarkovModel:
 
         syllable_count = 0
 
-        state = np.random.choice(list(range(self.L)))
+        state = self.sample_start()
 
         while syllable_count < M:
-            state = np.random.choice(list(range(self.L)), p=self.A[state])
+            state = self.sample_transition(state)
 
-            choice = -1
-            s_count = -1
-
-            while (syllable_count + s_count > M or s_count == -1):
-                choice = np.random.choice(list(range(self.D)), p=self.O[state])
-                s_count = self.get_syllables(inv_obs_map[choice], syl_dict, M - syllable_count)
+            choice, s_count = self._sample_fitting(state, inv_obs_map, syl_dict,
+                                                   M - syllable_count)
 
             syllable_count += s_count
             emission.append(choice)
             states.append(state)
 
+        if self.stats is not None:
+            self.stats.count('lines')
+            self.stats.count('words', len(emission))
+
         return emission, states
 
-    # given a seed word idx (from observation_map), find the state is in
-    def find_state(self, seed_word_idx):
-        probs = [elem[seed_word_idx] for elem in self.O]
+    def state_word_weights(self, X=None, batch_size=4096):
+        '''
+        Returns an L x D array whose i^th row weighs every observation by
+        how strongly state i emits it, for visualizing the states without
+        sampling a long emission.
+
+        Arguments:
+            X:          Optional dataset, as a list of lists or an
+                        HMM_corpus.EncodedCorpus. Without it the weights
+                        are the rows of O. With it they are the expected
+                        number of times each state emitted each
+                        observation in X, i.e. the posterior counts of the
+                        Baum-Welch E-step.
+
+            batch_size: Maximum number of equal-length sequences whose
+                        posteriors are computed together.
 
-        total = sum(probs)
+        Returns:
+            weights:    The weights. They are cached for as long as the
+                        model (and X) stay the same objects; do not modify
+                        them.
+        '''
 
-        probs = [p / total for p in probs]
-        rand_uniform = random.uniform(0, 1)
+        if X is None:
+            return self._cached('state_words', self.O, _dense)
 
-        chosen_state = 0
+        def build(sources):
+            A, O, A_start, X = sources
+            return _expected_statistics(A, _dense(O), A_start,
+                                        _length_buckets(X, batch_size))[1]
 
-        while rand_uniform > 0:
-            rand_uniform -= probs[chosen_state]
-            chosen_state += 1
-        return chosen_state - 1
+        return self._cached('state_words_posterior',
+                            (self.A, self.O, self.A_start, X), build)
+
+
+    # given a seed word idx (from observation_map), find the state is in
+    def find_state(self, seed_word_idx):
+        if isinstance(self.O, TopKEmissions):
+            # One column costs a lookup per state; no table is kept.
+            return AliasTable(self.O.columns(seed_word_idx)).sample()
+
+        # Row w of the table samples a state in proportion to O[:, w].
+        table = self._cached('O_columns', self.O,
+                             lambda O: AliasTable(np.asarray(O).T))
+        return table.sample(seed_word_idx)
 
     # given a number of syllables, a inverted obs map (obx idx to word), and a syllable dictionary), and a seed word
-    # return indices corresponding to a sonnet in reverse order
+    # return indices corresponding to a sonnet in reverse order. syl_dict may also be a SyllableIndex.
     def generate_sonnet_rhyme_emission(self, M, seed_word_idx, inv_obs_map, syl_dict):
 
         emission = []
@@ -479,23 +1097,24 @@ class HiddenMarkovModel:
 
                 states.append(state)
                 emission.append(seed_word_idx)
-                syllable_count += self.get_syllables(inv_obs_map[seed_word_idx], syl_dict, M)
+                syllable_count += int(self._syllable_counts(
+                    inv_obs_map, syl_dict, M)[seed_word_idx])
 
                 continue
 
-            state = np.random.choice(list(range(self.L)), p=self.A[state])
-
-            choice = -1
-            s_count = -1
+            state = self.sample_transition(state)
 
-            while (syllable_count + s_count > M or s_count == -1):
-                choice = np.random.choice(list(range(self.D)), p=self.O[state])
-                s_count = self.get_syllables(inv_obs_map[choice], syl_dict, M - syllable_count)
+            choice, s_count = self._sample_fitting(state, inv_obs_map, syl_dict,
+                                                   M - syllable_count)
 
             syllable_count += s_count
             emission.append(choice)
             states.append(state)
 
+        if self.stats is not None:
+            self.stats.count('lines')
+            self.stats.count('words', len(emission))
+
         return emission, states
     
     ################################################################################
@@ -516,14 +1135,11 @@ class HiddenMarkovModel:
             prob:       Total probability that x can occur.
         '''
 
-        # Calculate alpha vectors.
-        alphas = self.forward(x)
-
-        # alpha_j(M) gives the probability that the state sequence ends
-        # in j. Summing this value over all possible states j gives the
-        # total probability of x paired with any state sequence, i.e.
-        # the probability of x.
-        prob = sum(alphas[-1])
+        # The scaling factors of the forward algorithm multiply out to the
+        # sum of the unscaled alpha_j(M) over all states j, i.e. the total
+        # probability of x paired with any state sequence. Summing their
+        # logs avoids underflow until the very end.
+        prob = np.exp(self.log_probability(x))
         return prob
 
 
@@ -540,20 +1156,417 @@ class HiddenMarkovModel:
             prob:       Total probability that x can occur.
         '''
 
-        betas = self.backward(x)
+        betas, scales = self.backward_scaled(x)
 
         # beta_j(1) gives the probability that the state sequence starts
         # with j. Summing this, multiplied by the starting transition
         # probability and the observation probability, over all states
         # gives the total probability of x paired with any state
-        # sequence, i.e. the probability of x.
-        prob = sum([betas[1][j] * self.A_start[j] * self.O[j][x[0]] \
-                    for j in range(self.L)])
+        # sequence, i.e. the probability of x. The betas are scaled, so
+        # add the logs of the scaling factors back in.
+        first = np.dot(betas[1] * np.asarray(self.A_start),
+                       _emission_columns(self.O, x[0]))
+
+        with np.errstate(divide='ignore'):
+            log_prob = np.log(first) + np.sum(np.log(scales[1:len(x)]))
+
+        prob = np.exp(log_prob)
 
         return prob
 
 
-def supervised_HMM(X, Y):
+def _viterbi_decode(log_A, log_Ox, log_start):
+    '''
+    Log-space Viterbi over a batch of equal-length sequences.
+
+    Arguments:
+        log_A:      Log of the L x L transition matrix.
+
+        log_Ox:     Array of shape (L, B, M). log_Ox[:, b, t] is the log
+                    of the observation matrix column of the t^th element
+                    of the b^th sequence.
+
+        log_start:  Log of the starting transition probabilities.
+
+    Returns:
+        paths:      Integer array of shape (B, M) of the max probability
+                    state sequences.
+
+        log_probs:  Array of length B of their joint log-probabilities.
+    '''
+
+    _, B, M = log_Ox.shape
+
+    # back[:, t, j] is the best previous state of a path that is in
+    # state j at position t.
+    back = np.zeros((B, M, len(log_A)), dtype=np.intp)
+
+    probs = log_start + log_Ox[:, :, 0].T
+
+    for t in range(1, M):
+        # cand[b, k, j] = probs[b, k] + log A[k, j]
+        cand = probs[:, :, None] + log_A
+        back[:, t] = cand.argmax(axis=1)
+        probs = np.take_along_axis(cand, back[:, t][:, None, :], axis=1)[:, 0]
+        probs += log_Ox[:, :, t].T
+
+    paths = np.zeros((B, M), dtype=np.intp)
+    paths[:, M - 1] = probs.argmax(axis=1)
+    log_probs = probs[np.arange(B), paths[:, M - 1]]
+
+    for t in range(M - 1, 0, -1):
+        paths[:, t - 1] = back[np.arange(B), t, paths[:, t]]
+
+    return paths, log_probs
+
+
+def _same_sources(a, b):
+    '''
+    Whether two cache sources are the same object, or tuples of the same
+    objects.
+    '''
+
+    if isinstance(a, tuple) and isinstance(b, tuple):
+        return len(a) == len(b) and all(x is y for x, y in zip(a, b))
+
+    return a is b
+
+
+def _as_emissions(O):
+    '''
+    Returns O as a float array, or unchanged if it is already a sparse
+    emission representation.
+    '''
+
+    if isinstance(O, TopKEmissions):
+        return O
+
+    return np.asarray(O, dtype=float)
+
+
+def _dense(O):
+    '''
+    Returns a dense copy of O if it is sparse, and O otherwise.
+    '''
+
+    if isinstance(O, TopKEmissions):
+        return O.toarray()
+
+    return O
+
+
+def _column_sums(O):
+    '''
+    Total emission probability of every observation over all states.
+    '''
+
+    if isinstance(O, TopKEmissions):
+        return O.residual.sum() + np.bincount(
+            O.indices.ravel(), (O.values - O.residual[:, None]).ravel(),
+            minlength=O.D)
+
+    return np.asarray(O).sum(axis=0)
+
+
+def _fitting_table(O, index):
+    '''
+    FittingTable of a dense or sparse observation matrix.
+    '''
+
+    if isinstance(O, TopKEmissions):
+        return TopKFittingTable(O, index)
+
+    return FittingTable(O, index)
+
+
+def _emission_columns(O, x):
+    '''
+    Equivalent of O[:, x] for dense and sparse observation matrices.
+    '''
+
+    if isinstance(O, TopKEmissions):
+        return O.columns(x)
+
+    return np.asarray(O)[:, x]
+
+
+def _lengths(X):
+    '''
+    Returns the length of every sequence of a list of lists or an
+    EncodedCorpus.
+    '''
+
+    if isinstance(X, EncodedCorpus):
+        return X.lengths
+
+    return np.array([len(x) for x in X], dtype=int)
+
+
+def _gather(X, idx, M):
+    '''
+    Returns sequences idx of X, which all have length M, as an integer
+    array of shape (len(idx), M).
+    '''
+
+    if isinstance(X, EncodedCorpus):
+        return X.rows(idx, M)
+
+    return np.asarray([X[i] for i in idx], dtype=np.intp).reshape(len(idx), M)
+
+
+def _count_distinct(X):
+    '''
+    Returns the number of distinct values in a list of lists or an
+    EncodedCorpus.
+    '''
+
+    if isinstance(X, EncodedCorpus):
+        return len(np.unique(X.tokens))
+
+    values = set()
+    for x in X:
+        values |= set(x)
+
+    return len(values)
+
+
+def _length_buckets(X, batch_size=4096):
+    '''
+    Groups a dataset of sequences by length so that the E-step can run on
+    whole batches at once. Equal-length sequences need no padding or
+    masking.
+
+    Arguments:
+        X:          A dataset consisting of input sequences in the form
+                    of lists of variable length, consisting of integers
+                    ranging from 0 to D - 1. In other words, a list of lists.
+
+        batch_size: Maximum number of sequences per batch.
+
+    Returns:
+        buckets:    List of integer arrays of shape (B, M). Each row is
+                    one sequence of X. Empty sequences are dropped.
+    '''
+
+    if isinstance(X, EncodedCorpus):
+        return X.buckets(batch_size)
+
+    by_length = {}
+
+    for x in X:
+        if len(x) > 0:
+            by_length.setdefault(len(x), []).append(x)
+
+    buckets = []
+
+    for M in sorted(by_length):
+        seqs = np.asarray(by_length[M], dtype=np.intp)
+
+        for i in range(0, len(seqs), batch_size):
+            buckets.append(seqs[i:i + batch_size])
+
+    return buckets
+
+
+def _forward_batch(A, A_start, Ox):
+    '''
+    Scaled forward algorithm over a batch of equal-length sequences.
+
+    Arguments:
+        A:          Transition matrix with dimensions L x L.
+
+        A_start:    Starting transition probabilities of length L.
+
+        Ox:         Array of shape (B, M, L). Ox[b, t] is the observation
+                    matrix column of the t^th element of sequence b.
+
+    Returns:
+        alphas:     Array of shape (B, M, L) of alphas rescaled to sum to
+                    one at every position.
+
+        scales:     Array of shape (B, M) of the scaling factors; their
+                    logs sum to the log-likelihood of each sequence.
+    '''
+
+    B, M, L = Ox.shape
+
+    alphas = np.empty((B, M, L))
+    scales = np.empty((B, M))
+
+    alpha = A_start * Ox[:, 0]
+
+    for t in range(M):
+        if t > 0:
+            alpha = alphas[:, t - 1].dot(A) * Ox[:, t]
+
+        total = alpha.sum(axis=1)
+        scales[:, t] = total
+        alphas[:, t] = alpha / np.where(total == 0, 1., total)[:, None]
+
+    return alphas, scales
+
+
+def _expected_statistics(A, O, A_start, buckets, stats=None):
+    '''
+    Computes the Baum-Welch E-step over batches of equal-length sequences.
+    Alphas, betas, gammas and xis are computed for a whole batch at a time
+    with scaled recursions, and the sufficient statistics are accumulated
+    with tensor contractions and weighted bincounts.
+
+    Arguments:
+        A:          Transition matrix with dimensions L x L.
+
+        O:          Observation matrix with dimensions L x D.
+
+        A_start:    Starting transition probabilities of length L.
+
+        buckets:    Batches of sequences as returned by _length_buckets.
+
+        stats:      Optional HMM_profile.Stats to record the time of the
+                    forward, backward and accumulation phases into.
+
+    Returns:
+        A_num:      L x L expected transition counts.
+
+        O_num:      L x D expected emission counts.
+
+        A_denom:    L x 1 expected number of transitions out of each state.
+
+        O_denom:    L x 1 expected number of emissions from each state.
+
+        log_prob:   Log-likelihood of all sequences under (A, O).
+    '''
+
+    A = np.asarray(A)
+    O = np.asarray(O)
+    A_start = np.asarray(A_start)
+    L, D = O.shape
+
+    A_num = np.zeros((L, L))
+    O_num = np.zeros((L, D))
+    A_denom = np.zeros((L, 1))
+    O_denom = np.zeros((L, 1))
+    log_prob = 0.
+
+    for batch in buckets:
+        B, M = batch.shape
+
+        if stats is not None:
+            start = time.perf_counter()
+
+        # Ox[b, t] is the column O[:, x_b^t+1].
+        Ox = O[:, batch].transpose(1, 2, 0)
+
+        alphas, scales = _forward_batch(A, A_start, Ox)
+
+        if stats is not None:
+            forward = time.perf_counter()
+
+        # The betas share the forward scaling factors, so that
+        # alphas * betas is already the posterior of each state.
+        betas = np.empty((B, M, L))
+        betas[:, M - 1] = 1.
+
+        for t in range(M - 2, -1, -1):
+            beta = (Ox[:, t + 1] * betas[:, t + 1]).dot(A.T)
+            total = scales[:, t + 1]
+            betas[:, t] = beta / np.where(total == 0, 1., total)[:, None]
+
+        with np.errstate(divide='ignore'):
+            log_prob += np.sum(np.log(scales))
+
+        if stats is not None:
+            backward = time.perf_counter()
+
+        gammas = alphas * betas
+        with np.errstate(invalid='ignore'):
+            gammas /= gammas.sum(axis=2, keepdims=True)
+
+        O_denom[:, 0] += gammas.sum(axis=(0, 1))
+        A_denom[:, 0] += gammas[:, :-1].sum(axis=(0, 1))
+
+        # Scatter-add the posteriors into the emission counts, one
+        # weighted bincount per state.
+        flat_x = batch.ravel()
+        flat_gammas = gammas.reshape(-1, L)
+
+        for k in range(L):
+            O_num[k] += np.bincount(flat_x, weights=flat_gammas[:, k],
+                                    minlength=D)
+
+        if M > 1:
+            # xi_t(j, k) = alpha_t(j) A(j, k) O(k, x^t+1) beta_t+1(k) / c_t+1,
+            # summed over every position and sequence of the batch.
+            nxt = Ox[:, 1:] * betas[:, 1:]
+            nxt /= np.where(scales[:, 1:] == 0, 1., scales[:, 1:])[:, :, None]
+            A_num += A * np.einsum('btj,btk->jk', alphas[:, :-1], nxt)
+
+        if stats is not None:
+            end = time.perf_counter()
+            stats.add_time('em_forward', forward - start)
+            stats.add_time('em_backward', backward - forward)
+            stats.add_time('em_accumulate', end - backward)
+            stats.count('em_sequences', B)
+
+    return A_num, O_num, A_denom, O_denom, log_prob
+
+
+def _shard_buckets(buckets, n_shards):
+    '''
+    Splits length-bucketed batches into roughly equal shards of sequences,
+    one per worker process. Empty shards are dropped.
+    '''
+
+    shards = [[] for _ in range(n_shards)]
+
+    for batch in buckets:
+        for shard, part in zip(shards, np.array_split(batch, n_shards)):
+            if len(part) > 0:
+                shard.append(part)
+
+    return [shard for shard in shards if shard]
+
+
+def _per_sequence(stats, n_seqs):
+    '''
+    Divides sufficient statistics by the number of sequences they were
+    collected over, so that mini-batches of any size can be blended.
+    '''
+
+    return tuple(np.asarray(stat) / n_seqs for stat in stats)
+
+
+def _reduce_statistics(results):
+    '''
+    Sums the sufficient statistics returned by several E-step workers.
+    '''
+
+    return tuple(sum(stat) for stat in zip(*results))
+
+
+# Shards of the training data held by each E-step worker process. Set once
+# by the pool initializer so that the corpus is not sent on every iteration.
+_worker_shards = None
+
+
+def _init_worker(shards):
+    global _worker_shards
+    _worker_shards = shards
+
+
+def _worker_statistics(task):
+    shard, (A, O, A_start), timed = task
+
+    if not timed:
+        return _expected_statistics(A, O, A_start, _worker_shards[shard])
+
+    stats = Stats()
+    result = _expected_statistics(A, O, A_start, _worker_shards[shard], stats)
+
+    return result, stats
+
+
+def supervised_HMM(X, Y, pseudocount=0.):
     '''
     Helper function to train a supervised HMM. The function determines the
     number of unique states and observations in the given data, initializes
@@ -563,26 +1576,20 @@ def supervised_HMM(X, Y):
     Arguments:
         X:          A dataset consisting of input sequences in the form
                     of lists of variable length, consisting of integers 
-                    ranging from 0 to D - 1. In other words, a list of lists.
+                    ranging from 0 to D - 1. In other words, a list of lists,
+                    or an HMM_corpus.EncodedCorpus.
 
         Y:          A dataset consisting of state sequences in the form
                     of lists of variable length, consisting of integers 
                     ranging from 0 to L - 1. In other words, a list of lists.
                     Note that the elements in X line up with those in Y.
-    '''
-    # Make a set of observations.
-    observations = set()
-    for x in X:
-        observations |= set(x)
 
-    # Make a set of states.
-    states = set()
-    for y in Y:
-        states |= set(y)
-    
-    # Compute L and D.
-    L = len(states)
-    D = len(observations)
+        pseudocount: Additive smoothing for the transition and emission
+                    counts.
+    '''
+    # Compute L and D from the sets of states and observations.
+    L = _count_distinct(Y)
+    D = _count_distinct(X)
 
 
     # Randomly initialize and normalize matrix A.
@@ -604,11 +1611,11 @@ def supervised_HMM(X, Y):
 
     # Train an HMM with labeled data.
     HMM = HiddenMarkovModel(A, O)
-    HMM.supervised_learning(X, Y)
+    HMM.supervised_learning(X, Y, pseudocount=pseudocount)
 
     return HMM
 
-def unsupervised_HMM(X, n_states, N_iters):
+def unsupervised_HMM(X, n_states, N_iters, tol=None, n_jobs=None, seed=None):
     '''
     Helper function to train an unsupervised HMM. The function determines the
     number of unique observations in the given data, initializes
@@ -618,25 +1625,172 @@ def unsupervised_HMM(X, n_states, N_iters):
     Arguments:
         X:          A dataset consisting of input sequences in the form
                     of lists of variable length, consisting of integers 
-                    ranging from 0 to D - 1. In other words, a list of lists.
+                    ranging from 0 to D - 1. In other words, a list of lists,
+                    or an HMM_corpus.EncodedCorpus.
 
         n_states:   Number of hidden states to use in training.
         
-        N_iters:    The number of iterations to train on.
+        N_iters:    The maximum number of iterations to train on.
+
+        tol:        Stop early once the relative improvement in
+                    log-likelihood drops below tol. The per-iteration
+                    history is available as HMM.history afterwards.
+
+        n_jobs:     Number of worker processes for the E-step. None or 1
+                    trains in this process.
+
+        seed:       Seed of the random initialization. None gives the
+                    historical initialization with seeds 2020 (A) and
+                    155 (O).
     '''
 
-    # Make a set of observations.
-    observations = set()
-    for x in X:
-        observations |= set(x)
-    
     # Compute L and D.
     L = n_states
-    D = len(observations)
+    D = _count_distinct(X)
+
+    A, O = _initial_matrices(L, D, seed)
+
+    # Train an HMM with unlabeled data.
+    HMM = HiddenMarkovModel(A, O)
+    HMM.unsupervised_learning(X, N_iters, tol=tol, n_jobs=n_jobs)
+
+    return HMM
+
+
+def unsupervised_HMM_restarts(X, n_states, N_iters, n_restarts=8, seeds=None,
+                              tol=None, n_jobs=None, prune_every=5, keep=0.5):
+    '''
+    Trains differently initialized HMMs side by side in worker processes
+    and returns the one with the highest log-likelihood. Training runs in
+    rounds of prune_every iterations; after each round only the best
+    fraction keep of the restarts goes on, so poor starts stop early.
+
+    Arguments:
+        X:          A dataset as for unsupervised_HMM.
+
+        n_states:   Number of hidden states to use in training.
+
+        N_iters:    The maximum number of iterations to train on.
+
+        n_restarts: Number of restarts, if seeds is not given.
+
+        seeds:      Initialization seed of every restart, as for
+                    unsupervised_HMM. Defaults to None (the historical
+                    initialization) followed by 1, 2, ...
+
+        tol:        Stop a restart once the relative improvement in
+                    log-likelihood drops below tol. The first iteration of
+                    a round is compared with the last of the round before.
+
+        n_jobs:     Number of worker processes. None uses one per restart,
+                    up to the number of CPUs; 1 trains in this process.
+
+        prune_every: Iterations per round.
+
+        keep:       Fraction of the restarts kept after every round. At
+                    least one is always kept.
+
+    Returns:
+        HMM:        The best model. HMM.history holds its per-iteration
+                    history, as after unsupervised_learning.
+
+        curves:     List of the log-likelihoods of every restart, in the
+                    order of seeds. As in HMM.history, each is that of the
+                    parameters before an update. Pruned restarts have
+                    shorter curves.
+    '''
+
+    if N_iters < 1:
+        raise ValueError('N_iters must be at least 1.')
+
+    if seeds is None:
+        seeds = [None] + list(range(1, n_restarts))
+
+    n = len(seeds)
+    L = n_states
+    D = _count_distinct(X)
+
+    # Pack the data once; workers receive it when they start.
+    if not isinstance(X, EncodedCorpus):
+        X = EncodedCorpus.from_sequences(X)
+
+    if n_jobs is None:
+        n_jobs = min(n, multiprocessing.cpu_count())
+
+    params = [(None, None)] * n
+    histories = [[] for _ in range(n)]
+    candidates = list(range(n))
+    converged = set()
+    done = 0
+
+    pool = None
+    if n_jobs > 1:
+        pool = multiprocessing.Pool(n_jobs, initializer=_init_restart_worker,
+                                    initargs=(X,))
+        run = pool.map
+    else:
+        _init_restart_worker(X)
+        run = lambda f, tasks: [f(task) for task in tasks]
+
+    try:
+        while done < N_iters:
+            running = [k for k in candidates if k not in converged]
+
+            if not running:
+                break
+
+            n_iters = min(prune_every, N_iters - done)
+            tasks = [(seeds[k], L, D) + params[k]
+                     + (n_iters, tol, _last_log_likelihood(histories[k]))
+                     for k in running]
+
+            results = run(_restart_round, tasks)
+
+            for k, (A, O, history, stopped) in zip(running, results):
+                params[k] = (A, O)
+                histories[k] += history
+
+                if stopped:
+                    converged.add(k)
+
+            done += n_iters
+
+            if done < N_iters:
+                candidates.sort(key=lambda k: histories[k][-1]['log_likelihood'],
+                                reverse=True)
+                candidates = candidates[:max(1, int(np.ceil(keep * len(candidates))))]
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        else:
+            _init_restart_worker(None)
+
+    best = max(candidates, key=lambda k: histories[k][-1]['log_likelihood'])
+
+    HMM = HiddenMarkovModel(*params[best])
+    HMM.history = histories[best]
+
+    curves = [[h['log_likelihood'] for h in history] for history in histories]
+
+    return HMM, curves
+
+
+def _initial_matrices(L, D, seed=None):
+    '''
+    Returns randomly initialized, row-normalized A and O as lists of lists.
+    With seed None, A and O come from random generators seeded with 2020
+    and 155, as unsupervised_HMM always did; otherwise both come from one
+    generator seeded with seed.
+    '''
+
+    if seed is None:
+        rng_A, rng_O = random.Random(2020), random.Random(155)
+    else:
+        rng_A = rng_O = random.Random(seed)
 
     # Randomly initialize and normalize matrix A.
-    random.seed(2020)
-    A = [[random.random() for i in range(L)] for j in range(L)]
+    A = [[rng_A.random() for i in range(L)] for j in range(L)]
 
     for i in range(len(A)):
         norm = sum(A[i])
@@ -644,16 +1798,61 @@ def unsupervised_HMM(X, n_states, N_iters):
             A[i][j] /= norm
     
     # Randomly initialize and normalize matrix O.
-    random.seed(155)
-    O = [[random.random() for i in range(D)] for j in range(L)]
+    O = [[rng_O.random() for i in range(D)] for j in range(L)]
 
     for i in range(len(O)):
         norm = sum(O[i])
         for j in range(len(O[i])):
             O[i][j] /= norm
 
-    # Train an HMM with unlabeled data.
-    HMM = HiddenMarkovModel(A, O)
-    HMM.unsupervised_learning(X, N_iters)
+    return A, O
 
-    return HMM
+
+# Training data of a random-restart worker process, set once by the pool
+# initializer.
+_restart_data = None
+
+
+def _init_restart_worker(X):
+    global _restart_data
+    _restart_data = X
+
+
+def _last_log_likelihood(history):
+    return history[-1]['log_likelihood'] if history else None
+
+
+def _restart_round(task):
+    '''
+    Runs one round of EM for one restart, starting from its seeded
+    initialization if it has no parameters yet. previous is the last
+    log-likelihood of the round before, or None, so that tol also applies
+    across rounds.
+
+    Returns:
+        A, O:       The parameters after the round.
+
+        history:    The history of the round, as from unsupervised_learning.
+
+        stopped:    Whether the restart converged within tol.
+    '''
+
+    seed, L, D, A, O, n_iters, tol, previous = task
+
+    if A is None:
+        A, O = _initial_matrices(L, D, seed)
+
+    hmm = HiddenMarkovModel(A, O)
+    history = []
+
+    for _ in range(n_iters):
+        history += hmm.unsupervised_learning(_restart_data, 1)
+        log_prob = history[-1]['log_likelihood']
+
+        if tol is not None and previous is not None \
+                and abs(log_prob - previous) <= tol * abs(previous):
+            return hmm.A, hmm.O, history, True
+
+        previous = log_prob
+
+    return hmm.A, hmm.O, history, False
@@ -0,0 +1,362 @@
+########################################
+# Benchmarks for the HMM and generation hot paths
+########################################
+
+# Times fixed workloads on the bundled corpora and saved model, writes the
+# results as JSON, and optionally compares them with a stored baseline:
+#
+#     python HMM_benchmark.py --out baseline.json
+#     ...
+#     python HMM_benchmark.py --out current.json --baseline baseline.json \
+#         --threshold 0.10 --threshold 'viterbi/.*=0.25'
+#
+# A benchmark regresses when its median time exceeds the baseline median by
+# more than its threshold, and the run then exits with status 1. Workloads
+# are seeded, so runs on the same machine time the same work. With --stats,
+# the models are instrumented with an HMM_profile.Stats and every result also
+# holds the counters and timers recorded over all of its calls; the hooks
+# then add a little to the times.
+
+import re
+import sys
+import copy
+import json
+import time
+import pickle
+import random
+import platform
+import argparse
+import numpy as np
+
+from HMM import HiddenMarkovModel
+from HMM_helper import parse_observations
+from HMM_profile import Stats
+from HMM_syllables import SyllableIndex
+
+
+SHAKESPEARE = 'data/shakespeare.txt'
+SYLLABLE_DICT = 'data/Syllable_dictionary.txt'
+MODEL = 'hmm_model/naive_hmm20.hmm'
+OBS_MAP = 'hmm_model/naive_obs_map.hmm'
+
+LENGTHS = [10, 100, 1000]
+STATES = [10, 20, 50]
+
+
+class Context:
+    '''
+    Data shared by the workloads, loaded once.
+
+    Parameters:
+        text:       Text of data/shakespeare.txt.
+
+        X:          The text parsed with parse_observations.
+
+        obs_map:    Observation map of the saved model.
+
+        hmm:        The saved 20-state model.
+
+        syllables:  SyllableIndex of the saved model's vocabulary.
+
+        stats:      Stats given to every model of the workloads, or None.
+    '''
+
+    def __init__(self, stats=None):
+        self.stats = stats
+
+        with open(SHAKESPEARE) as f:
+            self.text = f.read()
+
+        with open(MODEL, 'rb') as f:
+            self.hmm = pickle.load(f)
+
+        with open(OBS_MAP, 'rb') as f:
+            self.obs_map = pickle.load(f)
+
+        self.X, _ = parse_observations(self.text, dict(self.obs_map))
+        self.inv_obs_map = {v: k for k, v in self.obs_map.items()}
+        self.syllables = SyllableIndex.build(self.obs_map, SYLLABLE_DICT)
+        self.tokens = np.array([x for line in self.X for x in line
+                                if x < self.hmm.D])
+        self.hmm.stats = stats
+
+    def random_model(self, L):
+        '''
+        Returns a seeded random model with L states over the saved model's
+        vocabulary.
+        '''
+
+        rng = np.random.RandomState(L)
+        A = rng.random_sample((L, L))
+        O = rng.random_sample((L, self.hmm.D))
+
+        hmm = HiddenMarkovModel(A / A.sum(axis=1, keepdims=True),
+                                O / O.sum(axis=1, keepdims=True))
+        hmm.stats = self.stats
+
+        return hmm
+
+
+####################
+# WORKLOADS
+####################
+
+# Every workload takes the Context and returns a list of (name, function)
+# pairs. Setup happens outside the functions, which are what is timed.
+
+def decoding(ctx):
+    cases = []
+
+    for L in STATES:
+        hmm = ctx.random_model(L)
+
+        for M in LENGTHS:
+            x = ctx.tokens[:M].tolist()
+            suffix = 'L%d/M%d' % (L, M)
+
+            cases.append(('forward/' + suffix, lambda h=hmm, x=x: h.forward(x)))
+            cases.append(('backward/' + suffix,
+                          lambda h=hmm, x=x: h.backward(x)))
+            cases.append(('viterbi/' + suffix, lambda h=hmm, x=x: h.viterbi(x)))
+
+    return cases
+
+
+def training(ctx):
+    X = [[x for x in line if x < ctx.hmm.D] for line in ctx.X]
+    X = [x for x in X if x]
+    Y, _ = ctx.hmm.viterbi_batch(X)
+    Y = [y.tolist() for y in Y]
+
+    def em_iteration():
+        hmm = ctx.random_model(10)
+        hmm.unsupervised_learning(X, 1)
+
+    def supervised():
+        hmm = ctx.random_model(ctx.hmm.L)
+        hmm.supervised_learning(X, Y)
+
+    return [('unsupervised_learning/L10/1iter', em_iteration),
+            ('supervised_learning/L20', supervised)]
+
+
+def generation(ctx):
+    hmm = copy.copy(ctx.hmm)
+    hmm._caches = {}
+    seed = ctx.obs_map['love']
+
+    def sonnet():
+        for _ in range(14):
+            hmm.generate_sonnet_emission(10, ctx.inv_obs_map, ctx.syllables)
+
+    def rhyme():
+        for _ in range(14):
+            hmm.generate_sonnet_rhyme_emission(10, seed, ctx.inv_obs_map,
+                                               ctx.syllables)
+
+    return [('generate_emission/M1000', lambda: hmm.generate_emission(1000)),
+            ('generate_sonnet_emission/14lines', sonnet),
+            ('generate_sonnet_rhyme_emission/14lines', rhyme)]
+
+
+def parsing(ctx):
+    return [('parse_observations/shakespeare',
+             lambda: parse_observations(ctx.text))]
+
+
+WORKLOADS = [decoding, training, generation, parsing]
+
+
+####################
+# TIMING AND COMPARISON
+####################
+
+def measure(function, repeat=5, min_time=0.05):
+    '''
+    Times a function. Each of repeat samples calls it as many times as
+    needed to last at least min_time seconds, after one warm-up call that
+    also fills any caches.
+
+    Returns:
+        result:     Dictionary of the minimum, median and mean seconds per
+                    call, the number of calls per sample, and the total
+                    number of calls including the warm-up.
+    '''
+
+    start = time.perf_counter()
+    function()
+    once = time.perf_counter() - start
+
+    number = max(1, int(min_time / max(once, 1e-9)))
+    samples = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        samples.append((time.perf_counter() - start) / number)
+
+    return {
+        'min': min(samples),
+        'median': float(np.median(samples)),
+        'mean': float(np.mean(samples)),
+        'number': number,
+        'repeat': repeat,
+        'calls': number * repeat + 1,
+    }
+
+
+def run(pattern=None, repeat=5, min_time=0.05, instrument=False,
+        verbose=True):
+    '''
+    Runs every benchmark whose name matches the regular expression pattern
+    (all of them by default). With instrument, the result of every
+    benchmark also holds the counters and timers of its calls ('stats').
+
+    Returns:
+        results:    Dictionary with the environment ('meta') and the timings
+                    of every benchmark by name ('results').
+    '''
+
+    np.random.seed(155)
+    random.seed(155)
+
+    ctx = Context(Stats() if instrument else None)
+    results = {}
+
+    for workload in WORKLOADS:
+        for name, function in workload(ctx):
+            if pattern is not None and not re.search(pattern, name):
+                continue
+
+            if ctx.stats is not None:
+                ctx.stats.reset()
+
+            results[name] = measure(function, repeat, min_time)
+
+            if ctx.stats is not None:
+                results[name]['stats'] = ctx.stats.as_dict()
+
+            if verbose:
+                print('%-45s %12.3f ms' % (name, 1e3 * results[name]['median']))
+
+    meta = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+    }
+
+    return {'meta': meta, 'results': results}
+
+
+def compare(current, baseline, threshold=0.10, overrides=()):
+    '''
+    Compares the median times of two result dictionaries.
+
+    Arguments:
+        current:    Results of this run.
+
+        baseline:   Stored results to compare with.
+
+        threshold:  Default allowed slowdown, as a fraction of the baseline.
+
+        overrides:  List of (pattern, threshold) pairs. The first pattern
+                    matching a benchmark name sets its threshold.
+
+    Returns:
+        rows:       List of (name, baseline, current, ratio, regressed) for
+                    every benchmark present in both results.
+    '''
+
+    rows = []
+
+    for name, result in current['results'].items():
+        if name not in baseline['results']:
+            continue
+
+        limit = threshold
+        for pattern, value in overrides:
+            if re.search(pattern, name):
+                limit = value
+                break
+
+        before = baseline['results'][name]['median']
+        after = result['median']
+        ratio = after / before if before > 0 else float('inf')
+
+        rows.append((name, before, after, ratio, ratio > 1. + limit))
+
+    return rows
+
+
+def _threshold(value):
+    '''
+    Parses --threshold: either a fraction, or PATTERN=fraction.
+    '''
+
+    if '=' in value:
+        pattern, fraction = value.rsplit('=', 1)
+        return pattern, float(fraction)
+
+    return None, float(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the HMM and generation hot paths.')
+    parser.add_argument('--out', help='path of the JSON results file')
+    parser.add_argument('--baseline', help='results file to compare with')
+    parser.add_argument('--threshold', type=_threshold, action='append',
+                        default=[], metavar='[PATTERN=]FRACTION',
+                        help='allowed slowdown, default 0.10; may be given '
+                             'per benchmark name pattern')
+    parser.add_argument('--filter', help='only run benchmarks matching this '
+                                         'regular expression')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.05,
+                        help='minimum seconds per sample')
+    parser.add_argument('--stats', action='store_true',
+                        help='record instrumentation counters and timers')
+
+    args = parser.parse_args(argv)
+
+    results = run(args.filter, args.repeat, args.min_time, args.stats)
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline is None:
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+    default = 0.10
+    overrides = []
+    for pattern, fraction in args.threshold:
+        if pattern is None:
+            default = fraction
+        else:
+            overrides.append((pattern, fraction))
+
+    rows = compare(results, baseline, default, overrides)
+    regressions = 0
+
+    print('\n%-45s %10s %10s %8s' % ('benchmark', 'base ms', 'now ms', 'ratio'))
+    for name, before, after, ratio, regressed in rows:
+        regressions += regressed
+        print('%-45s %10.3f %10.3f %7.2fx%s' % (name, 1e3 * before, 1e3 * after,
+                                                ratio,
+                                                '  REGRESSION' if regressed
+                                                else ''))
+
+    print('\n%d of %d benchmarks regressed.' % (regressions, len(rows)))
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,258 @@
+########################################
+# Streaming corpus tokenizer
+########################################
+
+# parse_observations needs a whole text in memory and builds a fresh
+# observation map every time. The generators here stream lines from any
+# number of files, clean them with precompiled patterns, and encode them
+# against an observation map that they extend in place, so that adding a
+# corpus only costs that corpus:
+#
+#     obs_map = {}
+#     obs = list(encode(tokenize(iter_lines(['data/shakespeare.txt'])),
+#                       obs_map))
+#     obs += encode(tokenize(iter_lines(['data/spenser.txt'])), obs_map)
+#
+# EncodedCorpus packs an encoded dataset into flat arrays that training and
+# decoding consume directly, so repeated runs can skip parsing entirely.
+
+import os
+import re
+import array
+import itertools
+import numpy as np
+
+
+_DIGITS = re.compile(r'\d')
+_HEADING = re.compile(r'^\s*[IVXLCDM]+\s*$')
+_NON_WORD = re.compile(r'[^\w]')
+_PUNCTUATION = re.compile('[.,?!";:]')
+_LINE_EDGES = re.compile('^[^a-zA-Z]*|[^a-zA-Z]*$')
+_PARENTHESES = re.compile(r'[\(\)]')
+_QUOTES = re.compile(r"(?<= )'|'(?= )")
+
+
+def iter_lines(paths):
+    '''
+    Yields the lines of every file in paths, one file after another,
+    without reading whole files into memory.
+    '''
+
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                yield line.rstrip('\n')
+
+
+def tokenize(lines, strip_digits=True, strip_headings=True,
+             keep_apostrophes=False, reverse=False):
+    '''
+    Cleans lines of text and yields each non-empty line as a list of words.
+
+    Arguments:
+        lines:              Iterable of lines.
+
+        strip_digits:       Remove digits, e.g. the sonnet numbers of
+                            data/shakespeare.txt.
+
+        strip_headings:     Drop lines that are only a Roman numeral, e.g.
+                            the sonnet numbers of data/spenser.txt.
+
+        keep_apostrophes:   With False, every word loses all non-word
+                            characters, as in parse_observations. With
+                            True, the rules of HMM_with_rhyme.ipynb apply:
+                            only sentence punctuation, parentheses, quotes
+                            and characters around the line are removed, so
+                            words like "beauty's" survive.
+
+        reverse:            Yield the words of every line in reverse order,
+                            for models that generate lines backwards from
+                            the rhyming word.
+    '''
+
+    for line in lines:
+        if strip_headings and _HEADING.match(line):
+            continue
+
+        if strip_digits:
+            line = _DIGITS.sub('', line)
+
+        line = line.lower()
+
+        if keep_apostrophes:
+            line = _PUNCTUATION.sub('', line)
+            line = _LINE_EDGES.sub('', line.strip())
+            line = _PARENTHESES.sub('', line)
+            words = _QUOTES.sub('', line).split()
+        else:
+            words = [_NON_WORD.sub('', word) for word in line.split()]
+
+        if words:
+            if reverse:
+                words.reverse()
+
+            yield words
+
+
+def encode(token_lines, obs_map):
+    '''
+    Yields every line of words as a list of observation indices. Words
+    missing from obs_map are added to it in place with the next free index.
+    '''
+
+    for words in token_lines:
+        obs_elem = []
+
+        for word in words:
+            i = obs_map.get(word)
+
+            if i is None:
+                i = obs_map[word] = len(obs_map)
+
+            obs_elem.append(i)
+
+        yield obs_elem
+
+
+def parse_files(paths, obs_map=None, **options):
+    '''
+    Reads, cleans and encodes files into a dataset.
+
+    Arguments:
+        paths:      Paths of the text files.
+
+        obs_map:    Observation map to extend, or None to start a new one.
+
+        options:    Cleaning options passed to tokenize.
+
+    Returns:
+        obs:        List of encoded lines.
+
+        obs_map:    The (extended) observation map.
+    '''
+
+    if obs_map is None:
+        obs_map = {}
+
+    obs = list(encode(tokenize(iter_lines(paths), **options), obs_map))
+
+    return obs, obs_map
+
+
+class EncodedCorpus:
+    '''
+    Encoded dataset packed into one flat token array plus offsets, i.e. the
+    CSR layout of a list of lists. It can be saved to a directory and
+    memory-mapped back, and HiddenMarkovModel accepts it anywhere it takes
+    a list of encoded lines.
+    '''
+
+    def __init__(self, tokens, offsets):
+        '''
+        Arguments:
+            tokens:     Integer array of every observation of every line.
+
+            offsets:    Integer array of length n + 1. Line i is
+                        tokens[offsets[i]:offsets[i + 1]].
+        '''
+
+        self.tokens = np.asarray(tokens)
+        self.offsets = np.asarray(offsets)
+
+    @classmethod
+    def from_sequences(cls, X):
+        '''
+        Packs a list of encoded lines.
+        '''
+
+        lengths = np.fromiter((len(x) for x in X), dtype=np.int64,
+                              count=len(X))
+        offsets = np.zeros(len(X) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        tokens = np.fromiter(itertools.chain.from_iterable(X),
+                             dtype=np.int32, count=int(offsets[-1]))
+
+        return cls(tokens, offsets)
+
+    @classmethod
+    def from_files(cls, paths, obs_map, **options):
+        '''
+        Streams, cleans and encodes files straight into a packed corpus,
+        extending obs_map in place. options are passed to tokenize.
+        '''
+
+        tokens = array.array('i')
+        offsets = array.array('q', [0])
+
+        for obs_elem in encode(tokenize(iter_lines(paths), **options),
+                               obs_map):
+            tokens.extend(obs_elem)
+            offsets.append(len(tokens))
+
+        return cls(np.frombuffer(tokens, dtype=np.int32),
+                   np.frombuffer(offsets, dtype=np.int64))
+
+    def save(self, directory):
+        '''
+        Writes tokens.npy and offsets.npy into directory.
+        '''
+
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'tokens.npy'),
+                self.tokens.astype(np.int32, copy=False))
+        np.save(os.path.join(directory, 'offsets.npy'),
+                self.offsets.astype(np.int64, copy=False))
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        '''
+        Opens a corpus written by save, memory-mapped by default.
+        '''
+
+        mode = 'r' if mmap else None
+
+        return cls(np.load(os.path.join(directory, 'tokens.npy'),
+                           mmap_mode=mode),
+                   np.load(os.path.join(directory, 'offsets.npy'),
+                           mmap_mode=mode))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def rows(self, idx, M):
+        '''
+        Gathers lines idx, which must all have length M, into an integer
+        array of shape (len(idx), M).
+        '''
+
+        starts = self.offsets[:-1][idx]
+        return self.tokens[starts[:, None] + np.arange(M)].astype(np.intp)
+
+    def buckets(self, batch_size=4096):
+        '''
+        Groups the non-empty lines by length into batches of at most
+        batch_size lines, as HMM._length_buckets does for lists.
+        '''
+
+        lengths = self.lengths
+        batches = []
+
+        for M in np.unique(lengths[lengths > 0]):
+            idx = np.flatnonzero(lengths == M)
+
+            for i in range(0, len(idx), batch_size):
+                batches.append(self.rows(idx[i:i + batch_size], M))
+
+        return batches
@@ -6,13 +6,14 @@
 # Description:  Set 6 HMM helper
 ########################################
 
-import re
 import numpy as np
 import matplotlib.pyplot as plt
-from wordcloud import WordCloud
+from wordcloud import WordCloud, STOPWORDS
 from matplotlib import animation
 from matplotlib.animation import FuncAnimation
 
+from HMM_corpus import tokenize, encode
+
 
 ####################
 # WORDCLOUD FUNCTIONS
@@ -51,30 +52,57 @@ def text_to_wordcloud(text, max_words=50, title='', show=True):
 
     return wordcloud
 
-def states_to_wordclouds(hmm, obs_map, max_words=50, show=True):
-    # Initialize.
-    M = 100000
-    n_states = len(hmm.A)
-    obs_map_r = obs_map_reverser(obs_map)
-    wordclouds = []
+def frequencies_to_wordcloud(frequencies, max_words=50, title='', show=True):
+    plt.close('all')
 
-    # Generate a large emission.
-    emission, states = hmm.generate_emission(M)
+    # Generate a wordcloud image from {word: weight}.
+    wordcloud = WordCloud(random_state=0,
+                          max_words=max_words,
+                          background_color='white',
+                          mask=mask()).generate_from_frequencies(frequencies)
 
-    # For each state, get a list of observations that have been emitted
-    # from that state.
-    obs_count = []
-    for i in range(n_states):
-        obs_lst = np.array(emission)[np.where(np.array(states) == i)[0]]
-        obs_count.append(obs_lst)
+    # Show the image.
+    if show:
+        plt.imshow(wordcloud, interpolation='bilinear')
+        plt.axis('off')
+        plt.title(title, fontsize=24)
+        plt.show()
 
-    # For each state, convert it into a wordcloud.
-    for i in range(n_states):
-        obs_lst = obs_count[i]
-        sentence = [obs_map_r[j] for j in obs_lst]
-        sentence_str = ' '.join(sentence)
+    return wordcloud
 
-        wordclouds.append(text_to_wordcloud(sentence_str, max_words=max_words, title='State %d' % i, show=show))
+def state_word_frequencies(hmm, obs_map, X=None, max_words=50):
+    # One {word: weight} table per state, built from hmm.state_word_weights
+    # instead of a sampled emission. Stopwords are dropped, as
+    # WordCloud.generate does for text. The tables are cached on the model.
+    weights = hmm.state_word_weights(X)
+
+    def build(sources):
+        weights, obs_map = sources
+        obs_map_r = obs_map_reverser(obs_map)
+        keep = np.array([obs_map_r[j] not in STOPWORDS
+                         for j in range(weights.shape[1])])
+
+        tables = []
+        for row in weights:
+            row = np.where(keep, row, 0.)
+            top = np.argsort(row)[::-1][:max_words]
+            tables.append({obs_map_r[j]: float(row[j])
+                           for j in top if row[j] > 0})
+
+        return tables
+
+    return hmm._cached(('word_frequencies', max_words), (weights, obs_map),
+                       build)
+
+def states_to_wordclouds(hmm, obs_map, max_words=50, show=True, X=None):
+    # Weigh the words of each state by O, or by posterior counts over the
+    # dataset X if it is given.
+    tables = state_word_frequencies(hmm, obs_map, X, max_words)
+    wordclouds = []
+
+    # For each state, convert it into a wordcloud.
+    for i, frequencies in enumerate(tables):
+        wordclouds.append(frequencies_to_wordcloud(frequencies, max_words=max_words, title='State %d' % i, show=show))
 
     return wordclouds
 
@@ -83,29 +111,15 @@ def states_to_wordclouds(hmm, obs_map, max_words=50, show=True):
 # HMM FUNCTIONS
 ####################
 
-def parse_observations(text):
-    # Convert text to dataset.
-    lines = [line.split() for line in text.split('\n') if line.split()]
-
-    obs_counter = 0
-    obs = []
-    obs_map = {}
+def parse_observations(text, obs_map=None):
+    # Convert text to dataset. Words missing from obs_map are added to it
+    # in place, so that several texts can share one observation map.
+    if obs_map is None:
+        obs_map = {}
 
-    for line in lines:
-        obs_elem = []
-        
-        for word in line:
-            word = re.sub(r'[^\w]', '', word).lower()
-            if word not in obs_map:
-                # Add unique words to the observations map.
-                obs_map[word] = obs_counter
-                obs_counter += 1
-            
-            # Add the encoded word.
-            obs_elem.append(obs_map[word])
-        
-        # Add the encoded sequence.
-        obs.append(obs_elem)
+    lines = tokenize(text.split('\n'), strip_digits=False,
+                     strip_headings=False)
+    obs = list(encode(lines, obs_map))
 
     return obs, obs_map
 
@@ -153,7 +167,7 @@ def visualize_sparsities(hmm, O_max_cols=50, O_vmax=0.1):
 # HMM ANIMATION FUNCTIONS
 ####################
 
-def animate_emission(hmm, obs_map, M=8, height=12, width=12, delay=1):
+def animate_emission(hmm, obs_map, M=8, height=12, width=12, delay=1, X=None):
     # Parameters.
     lim = 1200
     text_x_offset = 40
@@ -170,7 +184,7 @@ def animate_emission(hmm, obs_map, M=8, height=12, width=12, delay=1):
     # Initialize.
     n_states = len(hmm.A)
     obs_map_r = obs_map_reverser(obs_map)
-    wordclouds = states_to_wordclouds(hmm, obs_map, max_words=20, show=False)
+    wordclouds = states_to_wordclouds(hmm, obs_map, max_words=20, show=False, X=X)
 
     # Initialize plot.    
     fig, ax = plt.subplots()
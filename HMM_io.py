@@ -0,0 +1,241 @@
+########################################
+# Model file format for HiddenMarkovModel
+########################################
+
+# A model file holds everything needed to generate text in one place:
+#
+#     magic       4 bytes, b'HMMF'
+#     version     uint32, little-endian
+#     header_len  uint64, little-endian
+#     header      JSON, describing every section below
+#     sections    raw little-endian arrays, each aligned to 64 bytes
+#
+# The sections are A, O and A_start as float64, the vocabulary as UTF-8 words
+# separated by newlines in observation order, and optionally the normal and
+# end-of-line syllable counts of a SyllableIndex. Arrays are opened with
+# np.memmap, so a cold start only reads the pages it touches and several
+# worker processes share them through the page cache.
+#
+# The running totals of online EM (HiddenMarkovModel.partial_fit) are not
+# stored; online training of a loaded model restarts from its A and O.
+#
+# Usage:
+#     python HMM_io.py convert hmm_model/naive_hmm20.hmm naive_hmm20.hmmf \
+#         --obs-map hmm_model/naive_obs_map.hmm \
+#         --syllables data/Syllable_dictionary.txt
+
+import sys
+import json
+import pickle
+import struct
+import argparse
+import numpy as np
+
+from HMM import HiddenMarkovModel, _dense
+from HMM_syllables import SyllableIndex, load_syllable_dict
+
+
+MAGIC = b'HMMF'
+VERSION = 1
+ALIGN = 64
+
+_PREAMBLE = struct.Struct('<4sIQ')
+
+
+def save_model(path, hmm, obs_map=None, syllables=None):
+    '''
+    Writes a model file.
+
+    Arguments:
+        path:       Output path.
+
+        hmm:        The HiddenMarkovModel to save. A sparse O is stored
+                    dense.
+
+        obs_map:    Optional dictionary from word to observation index.
+
+        syllables:  Optional SyllableIndex of the same observations.
+    '''
+
+    sections = [
+        ('A', np.asarray(hmm.A, dtype='<f8')),
+        ('O', np.asarray(_dense(hmm.O), dtype='<f8')),
+        ('A_start', np.asarray(hmm.A_start, dtype='<f8')),
+    ]
+
+    if obs_map is not None:
+        words = [None] * len(obs_map)
+        for word, i in obs_map.items():
+            words[i] = word
+
+        blob = '\n'.join(words).encode('utf-8')
+        sections.append(('vocab', np.frombuffer(blob, dtype=np.uint8)))
+
+    if syllables is not None:
+        sections.append(('syllables_normal', np.asarray(syllables.normal,
+                                                        dtype='i1')))
+        sections.append(('syllables_end', np.asarray(syllables.end,
+                                                     dtype='i1')))
+
+    header = {'L': int(hmm.L), 'D': int(hmm.D), 'sections': {}}
+
+    if syllables is not None:
+        header['vocab_hash'] = syllables.vocab_hash
+
+    # The offsets are part of the header, so grow the space reserved for
+    # the header until it fits in front of the first section.
+    start = ALIGN
+
+    while True:
+        offset = start
+        for name, array in sections:
+            header['sections'][name] = {
+                'dtype': array.dtype.str,
+                'shape': list(array.shape),
+                'offset': offset,
+            }
+            offset = _align(offset + array.nbytes)
+
+        encoded = json.dumps(header).encode('utf-8')
+
+        if _PREAMBLE.size + len(encoded) <= start:
+            break
+
+        start = _align(_PREAMBLE.size + len(encoded))
+
+    with open(path, 'wb') as f:
+        f.write(_PREAMBLE.pack(MAGIC, VERSION, len(encoded)))
+        f.write(encoded)
+
+        for name, array in sections:
+            f.seek(header['sections'][name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+
+
+def read_header(path):
+    '''
+    Returns the JSON header of a model file.
+    '''
+
+    with open(path, 'rb') as f:
+        magic, version, length = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+
+        if magic != MAGIC:
+            raise ValueError('%s is not a model file.' % path)
+
+        if version > VERSION:
+            raise ValueError('%s has version %d; this code reads up to %d.'
+                             % (path, version, VERSION))
+
+        return json.loads(f.read(length).decode('utf-8'))
+
+
+def load_model(path, mmap=True):
+    '''
+    Opens a model file.
+
+    Arguments:
+        path:       Path of the model file.
+
+        mmap:       Whether to memory-map the arrays instead of reading
+                    them into memory.
+
+    Returns:
+        hmm:        The HiddenMarkovModel.
+
+        obs_map:    Dictionary from word to observation index, or None if
+                    the file has no vocabulary.
+
+        syllables:  SyllableIndex, or None if the file has none.
+    '''
+
+    header = read_header(path)
+    sections = header['sections']
+
+    def section(name):
+        info = sections[name]
+
+        if mmap:
+            return np.memmap(path, dtype=info['dtype'], mode='r',
+                             offset=info['offset'],
+                             shape=tuple(info['shape']))
+
+        with open(path, 'rb') as f:
+            f.seek(info['offset'])
+            count = int(np.prod(info['shape']))
+            return np.fromfile(f, dtype=info['dtype'],
+                               count=count).reshape(info['shape'])
+
+    hmm = HiddenMarkovModel(section('A'), section('O'))
+    hmm.A_start = section('A_start')
+
+    obs_map = None
+    if 'vocab' in sections:
+        words = bytes(section('vocab')).decode('utf-8').split('\n')
+        obs_map = {word: i for i, word in enumerate(words)}
+
+    syllables = None
+    if 'syllables_normal' in sections:
+        syllables = SyllableIndex(section('syllables_normal'),
+                                  section('syllables_end'),
+                                  header.get('vocab_hash', ''))
+
+    return hmm, obs_map, syllables
+
+
+def convert_pickle(model_path, out_path, obs_map_path=None,
+                   syllable_dict_path=None):
+    '''
+    Converts a pickled HiddenMarkovModel (and optionally its pickled
+    observation map) into a model file. With a syllable dictionary, the
+    compiled SyllableIndex is stored as well.
+    '''
+
+    with open(model_path, 'rb') as f:
+        hmm = pickle.load(f)
+
+    obs_map = None
+    if obs_map_path is not None:
+        with open(obs_map_path, 'rb') as f:
+            obs_map = pickle.load(f)
+
+    syllables = None
+    if syllable_dict_path is not None:
+        if obs_map is None:
+            raise ValueError('Syllable data needs the observation map.')
+
+        inv_obs_map = {v: k for k, v in obs_map.items()}
+        syllables = SyllableIndex.from_dictionary(
+            inv_obs_map, load_syllable_dict(syllable_dict_path), hmm.D)
+
+    save_model(out_path, hmm, obs_map, syllables)
+
+
+def _align(n):
+    return -(-n // ALIGN) * ALIGN
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Convert and inspect HiddenMarkovModel files.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    convert = commands.add_parser('convert', help='convert a pickled model')
+    convert.add_argument('model')
+    convert.add_argument('out')
+    convert.add_argument('--obs-map')
+    convert.add_argument('--syllables', help='path of the syllable dictionary')
+
+    info = commands.add_parser('info', help='print the header of a model file')
+    info.add_argument('path')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'convert':
+        convert_pickle(args.model, args.out, args.obs_map, args.syllables)
+    else:
+        print(json.dumps(read_header(args.path), indent=2))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
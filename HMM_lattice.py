@@ -0,0 +1,332 @@
+########################################
+# Exact syllable-constrained sampling for HiddenMarkovModel
+########################################
+
+# generate_sonnet_emission enforces meter one word at a time, which can dead
+# end and favors short words near the end of a line. Here the constraint is
+# solved exactly on a lattice over (hidden state, syllables remaining):
+#
+#     V[r][z]   probability that a line with r syllables left, whose next
+#               word is emitted from state z, ends on exactly 0 syllables.
+#     W[r]      A . V[r], the same one transition earlier.
+#
+# V is filled from r = 1 upwards once per model and syllable index. Lines are
+# then drawn front to back from the exact conditional distribution given the
+# syllable budget, weighting every choice by the V of what is left, so each
+# word costs O(L + r + log D).
+
+import numpy as np
+
+
+class SyllableLattice:
+    '''
+    Lattice of completion probabilities over (state, syllables remaining).
+    '''
+
+    def __init__(self, A, O, A_start, index, R):
+        '''
+        Arguments:
+            A:          Transition matrix with dimensions L x L.
+
+            O:          Dense observation matrix with dimensions L x D.
+
+            A_start:    Starting transition probabilities of length L.
+
+            index:      HMM_syllables.SyllableIndex of the observations.
+
+            R:          Largest syllable budget the lattice supports.
+
+        Parameters:
+            V, W:       Arrays of shape (R + 1, L) as described above.
+
+            counts:     counts[r] is index.counts(r), the syllables every
+                        word uses when r are left, or -1.
+
+            order:      order[r] lists the words that fit in r syllables,
+                        sorted by the number of syllables they use.
+
+            bounds:     order[r][bounds[r][k]:bounds[r][k + 1]] are the
+                        words that use k syllables when r are left.
+
+            cum:        cum[r] has shape (L, len(order[r]) + 1). Row z holds
+                        the running sums of O[z] over order[r].
+
+            flat:       flat[r] is cum[r] with 2 * z added to row z and
+                        flattened, so that one binary search finds words of
+                        many states at once.
+        '''
+
+        self.A = np.asarray(A, dtype=float)
+        self.O = np.asarray(O, dtype=float)
+        self.R = R
+        L = len(self.A)
+
+        # First emitting state: a start state followed by one transition,
+        # as in generate_sonnet_emission.
+        self.first = np.asarray(A_start, dtype=float).dot(self.A)
+
+        self.counts = [np.full(self.O.shape[1], -1)]
+        self.order = [np.zeros(0, dtype=int)]
+        self.bounds = [np.zeros(2, dtype=int)]
+        self.cum = [np.zeros((L, 1))]
+        self.flat = [np.zeros(L)]
+
+        self.V = np.zeros((R + 1, L))
+        self.W = np.zeros((R + 1, L))
+
+        for r in range(1, R + 1):
+            counts = index.counts(r)
+            self.counts.append(counts)
+            fits = np.flatnonzero(counts > 0)
+            order = fits[np.argsort(counts[fits], kind='stable')]
+
+            self.order.append(order)
+            self.bounds.append(np.searchsorted(counts[order],
+                                               np.arange(r + 2)))
+
+            cum = np.zeros((L, len(order) + 1))
+            np.cumsum(self.O[:, order], axis=1, out=cum[:, 1:])
+            self.cum.append(cum)
+            self.flat.append((cum + 2. * np.arange(L)[:, None]).ravel())
+
+            # E[:, k] is the emission mass that uses k syllables.
+            E = self.emission_mass(r)
+
+            self.V[r] = E[:, r]
+            for k in range(1, r):
+                self.V[r] += E[:, k] * self.W[r - k]
+
+            self.W[r] = self.A.dot(self.V[r])
+
+    def emission_mass(self, r):
+        '''
+        Returns an array of shape (L, r + 1) whose (z, k)^th element is the
+        probability that state z emits a word using k of r syllables left.
+        '''
+
+        cum = self.cum[r]
+        b = self.bounds[r]
+
+        return cum[:, b[1:]] - cum[:, b[:-1]]
+
+    def step_weights(self, z, r):
+        '''
+        Returns the unnormalized probabilities over k = 0..r that the word
+        emitted from state z uses k syllables, given that the line ends
+        exactly.
+        '''
+
+        weights = self.emission_mass(r)[z].copy()
+        weights[:r] *= np.append(0., self.W[r - 1:0:-1, z])
+
+        return weights
+
+    def draw_word(self, z, r, k, u):
+        '''
+        Returns a word of state z that uses k of r syllables left, drawn in
+        proportion to O[z] from a uniform number u in [0, 1).
+        '''
+
+        cum = self.cum[r][z]
+        start, end = self.bounds[r][k], self.bounds[r][k + 1]
+
+        target = cum[start] + u * (cum[end] - cum[start])
+        j = np.searchsorted(cum[start + 1:end + 1], target, side='right')
+
+        return int(self.order[r][start + min(j, end - start - 1)])
+
+    def sample(self, M, seed_word_idx=None, uniform=np.random.random_sample):
+        '''
+        Draws a line of exactly M syllables from the conditional
+        distribution of the model given its length in syllables.
+
+        Arguments:
+            M:              Number of syllables, at most R.
+
+            seed_word_idx:  Optional observation forced as the first word.
+
+            uniform:        Function returning a uniform number in [0, 1).
+
+        Returns:
+            emission:       The sampled observations as a list.
+
+            states:         The sampled states as a list.
+        '''
+
+        emission = []
+        states = []
+        r = M
+
+        prior = self.first * self.V[M]
+
+        if seed_word_idx is not None:
+            k = int(self.counts[M][seed_word_idx])
+
+            if k <= 0:
+                raise ValueError('The seed word does not fit in %d '
+                                 'syllables.' % M)
+
+            prior = self.first * self.O[:, seed_word_idx]
+            prior = prior * (self.W[M - k] if k < M else 1.)
+
+        z = _draw(prior, uniform())
+
+        if z < 0:
+            raise ValueError('No line of %d syllables is possible.' % M)
+
+        if seed_word_idx is not None:
+            emission.append(int(seed_word_idx))
+            states.append(z)
+            r -= k
+
+            if r > 0:
+                z = _draw(self.A[z] * self.V[r], uniform())
+
+        while r > 0:
+            k = _draw(self.step_weights(z, r), uniform())
+            emission.append(self.draw_word(z, r, k, uniform()))
+            states.append(z)
+            r -= k
+
+            if r > 0:
+                z = _draw(self.A[z] * self.V[r], uniform())
+
+        return emission, states
+
+
+    def sample_batch(self, M, uniforms, seed_word_idxs=None):
+        '''
+        Draws many lines of exactly M syllables in lockstep. Every step
+        advances all unfinished lines with vectorized draws.
+
+        Arguments:
+            M:              Number of syllables, at most R.
+
+            uniforms:       Array of shape (N, 2 + 3 * M) of uniform
+                            numbers in [0, 1). Row i is the random stream
+                            of line i.
+
+            seed_word_idxs: Optional array of N observations forced as the
+                            first word of each line.
+
+        Returns:
+            emissions:      Integer array of shape (N, M), padded with -1.
+
+            states:         Integer array of shape (N, M), padded with -1.
+
+            lengths:        Number of words of every line.
+        '''
+
+        N = len(uniforms)
+        L = len(self.A)
+        rows = np.arange(N)
+
+        emissions = np.full((N, M), -1, dtype=int)
+        states = np.full((N, M), -1, dtype=int)
+        lengths = np.zeros(N, dtype=int)
+        left = np.full(N, M)
+
+        if seed_word_idxs is None:
+            prior = np.tile(self.first * self.V[M], (N, 1))
+        else:
+            seeds = np.asarray(seed_word_idxs, dtype=int)
+            k = self.counts[M][seeds]
+
+            if np.any(k <= 0):
+                raise ValueError('A seed word does not fit in %d '
+                                 'syllables.' % M)
+
+            rest = np.vstack([self.W[M - k[i]] if k[i] < M else np.ones(L)
+                              for i in range(N)])
+            prior = self.first * self.O[:, seeds].T * rest
+
+        z = _draw_rows(prior, uniforms[:, 0])
+
+        if np.any(z < 0):
+            raise ValueError('No line of %d syllables is possible.' % M)
+
+        if seed_word_idxs is not None:
+            emissions[:, 0] = seeds
+            states[:, 0] = z
+            lengths[:] = 1
+            left -= k
+            z = self._next_states(z, left, uniforms[:, 1])
+
+        step = 0
+
+        while np.any(left > 0):
+            step += 1
+
+            for r in np.unique(left[left > 0]):
+                idx = rows[left == r]
+                zs = z[idx]
+                u = uniforms[idx, 3 * step - 1:3 * step + 2]
+
+                # Syllables used by the next word of every line.
+                weights = self.emission_mass(r)[zs]
+                weights[:, 1:r] *= self.W[r - 1:0:-1, zs].T
+                k = _draw_rows(weights, u[:, 0])
+
+                # The word itself, found for all lines with one search.
+                b = self.bounds[r]
+                start, end = b[k], b[k + 1]
+                cum = self.cum[r]
+                width = cum.shape[1]
+                lo = cum[zs, start]
+                target = lo + u[:, 1] * (cum[zs, end] - lo) + 2. * zs
+                j = np.searchsorted(self.flat[r], target, side='right')
+                j = np.clip(j - zs * width - 1, start, end - 1)
+
+                emissions[idx, lengths[idx]] = self.order[r][j]
+                states[idx, lengths[idx]] = zs
+                lengths[idx] += 1
+                left[idx] -= k
+
+                z[idx] = self._next_states(zs, left[idx], u[:, 2])
+
+        return emissions, states, lengths
+
+    def _next_states(self, z, left, u):
+        '''
+        Draws the next state of every line that has syllables left.
+        '''
+
+        z = z.copy()
+        going = left > 0
+
+        if np.any(going):
+            weights = self.A[z[going]] * self.V[left[going]]
+            z[going] = _draw_rows(weights, u[going])
+
+        return z
+
+
+def _draw_rows(weights, u):
+    '''
+    Draws one index per row of weights in proportion to the row, from the
+    uniform numbers u. Rows without mass give -1.
+    '''
+
+    cum = np.cumsum(weights, axis=1)
+    totals = cum[:, -1]
+
+    idx = (cum <= (u * totals)[:, None]).sum(axis=1)
+    idx = np.minimum(idx, cum.shape[1] - 1)
+    idx[totals <= 0] = -1
+
+    return idx
+
+
+def _draw(weights, u):
+    '''
+    Returns an index drawn in proportion to weights from a uniform number u,
+    or -1 if the weights have no mass.
+    '''
+
+    cum = np.cumsum(weights)
+
+    if cum[-1] <= 0:
+        return -1
+
+    return int(min(np.searchsorted(cum, u * cum[-1], side='right'),
+                   len(cum) - 1))
@@ -0,0 +1,405 @@
+########################################
+# Pre-generated line pool for rhyming sonnets
+########################################
+
+# A rhyming sonnet needs 14 lines that end on given rhyme words. Instead of
+# generating them per request, a LinePool holds many ready lines for every
+# rhymeable word that fits a line, generated offline in large batches with
+# HiddenMarkovModel.generate_lines. A sonnet is then assembled from 7 rhyme
+# pairs and 14 dictionary lookups, and every line is served only once.
+#
+# The pool needs a model that generates lines back to front, such as
+# hmm_rhyme.model, so that the seed word of a line is its last word.
+#
+# On disk, a pool is a directory with
+#
+#     tokens.npy, offsets.npy   the lines as an HMM_corpus.EncodedCorpus,
+#                               sorted by end word
+#     word_offsets.npy          lines of word w are word_offsets[w] up to
+#                               word_offsets[w + 1]
+#     pool.json                 syllables per line and the vocabulary hash
+#
+# Lines of a word are only read from disk the first time the word is used.
+#
+#     python HMM_pool.py build pool/ --per-word 64
+
+import os
+import sys
+import json
+import argparse
+import threading
+import collections
+import numpy as np
+
+from HMM_corpus import EncodedCorpus
+from HMM_rhyme import SHAKESPEARE_PAIRS
+from HMM_server import Poet
+
+
+class LinePool:
+    '''
+    Lines of M syllables, stored by end word, each served at most once.
+    '''
+
+    def __init__(self, corpus, word_offsets, M=10, vocab_hash=''):
+        '''
+        Arguments:
+            corpus:         EncodedCorpus of the stored lines, as emitted
+                            (end word first), sorted by end word.
+
+            word_offsets:   Integer array of length D + 1 indexing corpus by
+                            end word.
+
+            M:              Syllables per line.
+
+            vocab_hash:     Digest of the vocabulary the lines use.
+        '''
+
+        self.corpus = corpus
+        self.word_offsets = np.asarray(word_offsets)
+        self.M = M
+        self.vocab_hash = vocab_hash
+
+        self._queues = {}
+        self._lock = threading.Lock()
+        self._low = 0
+        self._wanted = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def build(cls, hmm, inv_obs_map, syllables, words, per_word=32, M=10,
+              rng=None, batch_size=8192):
+        '''
+        Generates per_word lines for every word of words that fits a line
+        of M syllables.
+
+        Arguments:
+            hmm:            HiddenMarkovModel that generates lines back to
+                            front.
+
+            inv_obs_map:    Dictionary (or list) from observation index to
+                            word.
+
+            syllables:      HMM_syllables.SyllableIndex of the observations.
+
+            words:          Observation indices to build lines for, e.g.
+                            RhymeIndex.words().
+
+            per_word:       Lines per word.
+
+            M:              Syllables per line.
+
+            rng:            A numpy Generator, or a seed for one.
+
+            batch_size:     Lines per generate_lines call.
+        '''
+
+        rng = np.random.default_rng(rng)
+        words = _fitting_words(words, syllables, M)
+
+        seeds = np.repeat(words, per_word)
+        lines = []
+
+        for i in range(0, len(seeds), batch_size):
+            emissions, _ = hmm.generate_lines(
+                len(seeds[i:i + batch_size]), M, inv_obs_map, syllables,
+                seeds[i:i + batch_size], rng)
+            lines.extend(emissions)
+
+        return cls._from_lines(lines, hmm.D, M, syllables.vocab_hash)
+
+    @classmethod
+    def _from_lines(cls, lines, D, M, vocab_hash):
+        ends = np.array([line[0] for line in lines], dtype=int)
+        order = np.argsort(ends, kind='stable')
+
+        word_offsets = np.zeros(D + 1, dtype=np.int64)
+        np.cumsum(np.bincount(ends, minlength=D), out=word_offsets[1:])
+
+        corpus = EncodedCorpus.from_sequences([lines[i] for i in order])
+
+        return cls(corpus, word_offsets, M, vocab_hash)
+
+    def save(self, directory):
+        '''
+        Writes the lines that have not been served yet, including refills.
+        '''
+
+        with self._lock:
+            D = len(self.word_offsets) - 1
+            lines = [line for w in range(D) for line in self._lines(w)]
+
+        pool = self._from_lines(lines, D, self.M, self.vocab_hash)
+        pool.corpus.save(directory)
+
+        np.save(os.path.join(directory, 'word_offsets.npy'), pool.word_offsets)
+
+        with open(os.path.join(directory, 'pool.json'), 'w') as f:
+            json.dump({'M': self.M, 'vocab_hash': self.vocab_hash}, f)
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        '''
+        Opens a pool written by save, memory-mapped by default.
+        '''
+
+        with open(os.path.join(directory, 'pool.json')) as f:
+            meta = json.load(f)
+
+        mode = 'r' if mmap else None
+
+        return cls(EncodedCorpus.load(directory, mmap),
+                   np.load(os.path.join(directory, 'word_offsets.npy'),
+                           mmap_mode=mode),
+                   meta['M'], meta['vocab_hash'])
+
+    def _queue(self, w):
+        queue = self._queues.get(w)
+
+        if queue is None:
+            start, end = self.word_offsets[w], self.word_offsets[w + 1]
+            queue = collections.deque(self.corpus[i].tolist()
+                                      for i in range(start, end))
+            self._queues[w] = queue
+
+        return queue
+
+    def _lines(self, w):
+        if w in self._queues:
+            return list(self._queues[w])
+
+        return [self.corpus[i].tolist()
+                for i in range(self.word_offsets[w], self.word_offsets[w + 1])]
+
+    def available(self, w):
+        '''
+        Number of unserved lines that end on observation w.
+        '''
+
+        with self._lock:
+            return len(self._queue(w))
+
+    def take(self, w):
+        '''
+        Removes and returns an unserved line ending on observation w, as
+        emitted (end word first), or None if there is none.
+        '''
+
+        with self._lock:
+            queue = self._queue(w)
+            line = queue.popleft() if queue else None
+
+            if len(queue) < self._low:
+                self._wanted.set()
+
+        return line
+
+    def put_back(self, w, line):
+        '''
+        Returns a line taken with take to the front of its queue.
+        '''
+
+        with self._lock:
+            self._queue(w).appendleft(line)
+
+    def refill(self, hmm, inv_obs_map, syllables, words, target=32, rng=None):
+        '''
+        Generates lines with one generate_lines call so that every word of
+        words that fits a line has target unserved lines again.
+
+        Returns:
+            n:          Number of lines generated.
+        '''
+
+        words = _fitting_words(words, syllables, self.M).tolist()
+
+        with self._lock:
+            need = [(w, target - len(self._queue(w))) for w in words]
+
+        seeds = np.repeat([w for w, n in need if n > 0],
+                          [n for w, n in need if n > 0])
+
+        if len(seeds) == 0:
+            return 0
+
+        emissions, _ = hmm.generate_lines(len(seeds), self.M, inv_obs_map,
+                                          syllables, seeds, rng)
+
+        with self._lock:
+            for line in emissions:
+                self._queue(line[0]).append(line)
+
+        return len(seeds)
+
+    def start_refill(self, hmm, inv_obs_map, syllables, words, low=8,
+                     target=32, rng=None):
+        '''
+        Starts a background thread that refills words of words up to target
+        lines whenever a take leaves one of them with fewer than low.
+        '''
+
+        rng = np.random.default_rng(rng)
+        words = _fitting_words(words, syllables, self.M)
+        self._low = low
+        self._stop.clear()
+
+        def run():
+            while not self._stop.is_set():
+                if not self._wanted.wait(0.1):
+                    continue
+
+                self._wanted.clear()
+
+                # A failed batch must not end the thread; the next take
+                # that runs low tries again.
+                try:
+                    self.refill(hmm, inv_obs_map, syllables, words, target,
+                                rng)
+                except Exception as error:
+                    print('Line pool refill failed: %r' % error,
+                          file=sys.stderr)
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+    def stop_refill(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+
+def _fitting_words(words, syllables, M):
+    '''
+    The distinct observations of words that fit a line of M syllables.
+    '''
+
+    words = np.unique(np.asarray(words, dtype=int))
+
+    return words[syllables.counts(M)[words] > 0]
+
+
+class SonnetAssembler:
+    '''
+    Builds rhyming sonnets from a LinePool.
+    '''
+
+    def __init__(self, pool, rhymes, inv_obs_map, rng=None, max_draws=64):
+        '''
+        Arguments:
+            pool:           The LinePool.
+
+            rhymes:         HMM_rhyme.RhymeIndex to draw end words from.
+
+            inv_obs_map:    Dictionary (or list) from observation index to
+                            word.
+
+            rng:            A numpy Generator, or a seed for one.
+
+            max_draws:      Rhyme pairs to try per sonnet before giving up.
+        '''
+
+        self.pool = pool
+        self.rhymes = rhymes
+        self.inv_obs_map = inv_obs_map
+        self.rng = np.random.default_rng(rng)
+        self.max_draws = max_draws
+
+    def assemble_emissions(self):
+        '''
+        Takes 14 lines that follow the Shakespearean rhyme scheme from the
+        pool. Raises ValueError if the pool cannot provide them.
+
+        Returns:
+            lines:      List of 14 emissions, each end word first.
+        '''
+
+        lines = [None] * 14
+        taken = []
+        slots = iter(SHAKESPEARE_PAIRS)
+        a, b = next(slots)
+
+        for w1, w2 in self.rhymes.sample_pairs(self.max_draws,
+                                               self.rng).tolist():
+            first = self.pool.take(w1)
+
+            if first is None:
+                continue
+
+            second = self.pool.take(w2)
+
+            if second is None:
+                self.pool.put_back(w1, first)
+                continue
+
+            lines[a], lines[b] = first, second
+            taken += [(w1, first), (w2, second)]
+            a, b = next(slots, (None, None))
+
+            if a is None:
+                return lines
+
+        # Return the lines of the pairs already filled, last taken first,
+        # so that every queue is as it was.
+        for w, line in reversed(taken):
+            self.pool.put_back(w, line)
+
+        raise ValueError('The line pool has too few lines for a sonnet.')
+
+    def assemble(self):
+        '''
+        Returns a sonnet as a list of 14 lines of text.
+        '''
+
+        sonnet = []
+
+        for emission in self.assemble_emissions():
+            line = ' '.join(self.inv_obs_map[w] for w in reversed(emission))
+            sonnet.append(line[:1].upper() + line[1:])
+
+        return sonnet
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Build a line pool for rhyming sonnets.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build = commands.add_parser('build', help='generate and save a pool')
+    build.add_argument('out')
+    build.add_argument('--per-word', type=int, default=32)
+
+    sonnet = commands.add_parser('sonnet', help='assemble from a saved pool')
+    sonnet.add_argument('pool')
+
+    for command in (build, sonnet):
+        command.add_argument('--model', default='hmm_rhyme.model')
+        command.add_argument('--corpus',
+                             default='data/shakespeare_no99_no126.txt')
+        command.add_argument('--seed', type=int)
+
+    args = parser.parse_args(argv)
+
+    poet = Poet.load(args.model, corpus_path=args.corpus, reversed=True,
+                     seed=args.seed)
+
+    if args.command == 'build':
+        pool = LinePool.build(poet.hmm, poet.words, poet.syllables,
+                              poet.rhymes.words(), args.per_word, rng=poet.rng)
+        pool.save(args.out)
+        print('%d lines for %d words.' % (len(pool.corpus),
+                                          np.count_nonzero(
+                                              np.diff(pool.word_offsets))))
+    else:
+        pool = LinePool.load(args.pool)
+
+        if pool.vocab_hash != poet.syllables.vocab_hash:
+            raise ValueError('The pool was built for another vocabulary.')
+
+        assembler = SonnetAssembler(pool, poet.rhymes, poet.words, poet.rng)
+        print('\n'.join(assembler.assemble()))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,115 @@
+########################################
+# Instrumentation for HiddenMarkovModel
+########################################
+
+# A HiddenMarkovModel records nothing by default: its stats attribute is
+# None and every hook is a single attribute check. Assigning a Stats turns
+# the hooks on:
+#
+#     hmm.stats = Stats()
+#     hmm.unsupervised_learning(X, 10)
+#     print(hmm.stats.as_dict())
+#
+# Counters and timers recorded by the model:
+#
+#     em_iterations, em_sequences       EM iterations and sequences per E-step
+#     em_forward, em_backward,          Time of the E-step phases and of the
+#     em_accumulate, em_m_step          M-step
+#     pyphen_fallbacks                  Words whose syllables came from pyphen
+#                                       because the dictionary lacks them
+#     lines, words                      Lines and words of the sonnet emitters
+#     transition_draws, emission_draws  Draws made by the sonnet emitters
+#     fitting_fallbacks                 Emissions drawn from all states because
+#                                       no word of the state fit the meter
+#     generate_lines                    Time of batched line generation
+#
+# The sonnet emitters draw from the words that fit the remaining syllables
+# directly, so they make no rejection retries: the draws per line are
+# transition_draws / lines and emission_draws / lines.
+
+import time
+import contextlib
+import collections
+
+
+class Stats:
+    '''
+    Counters and timers filled by an instrumented HiddenMarkovModel.
+    '''
+
+    def __init__(self, callback=None):
+        '''
+        Arguments:
+            callback:   Optional function called as callback(name, value)
+                        on every count (value is the increment) and every
+                        timing (value is the seconds).
+
+        Parameters:
+            counters:   Dictionary from name to count.
+
+            timers:     Dictionary from name to total seconds.
+
+            calls:      Dictionary from timer name to number of timings.
+        '''
+
+        self.callback = callback
+        self.reset()
+
+    def reset(self):
+        self.counters = collections.Counter()
+        self.timers = collections.Counter()
+        self.calls = collections.Counter()
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+        if self.callback is not None:
+            self.callback(name, n)
+
+    def add_time(self, name, seconds):
+        self.timers[name] += seconds
+        self.calls[name] += 1
+
+        if self.callback is not None:
+            self.callback(name, seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        '''
+        Context manager that adds the time spent in its block to name.
+        '''
+
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def merge(self, other):
+        '''
+        Adds the counts and times of another Stats, e.g. of a worker
+        process.
+        '''
+
+        self.counters.update(other.counters)
+        self.timers.update(other.timers)
+        self.calls.update(other.calls)
+
+    def as_dict(self):
+        '''
+        Returns the counts and times as plain dictionaries, ready for JSON.
+        '''
+
+        return {
+            'counters': dict(self.counters),
+            'timers': {name: {'seconds': self.timers[name],
+                              'calls': self.calls[name]}
+                       for name in self.timers},
+        }
+
+    def __getstate__(self):
+        # Callbacks may not pickle; worker processes record without them.
+        state = self.__dict__.copy()
+        state['callback'] = None
+        return state
@@ -0,0 +1,220 @@
+########################################
+# Rhyme index for rhyming sonnet generation
+########################################
+
+# Words that end rhyming lines of the training sonnets are merged into
+# equivalence classes with union-find over observation indices. The classes
+# are stored as flat arrays, so that a rhyming pair is drawn in constant time:
+# pick a member of any class of size >= 2 uniformly, then any other member of
+# its class.
+
+import re
+import numpy as np
+
+from HMM_syllables import clean_word
+
+
+# Pairs of rhyming line positions in a 14-line sonnet.
+SHAKESPEARE_PAIRS = [(0, 2), (1, 3), (4, 6), (5, 7), (8, 10), (9, 11),
+                     (12, 13)]
+
+SPENSER_PAIRS = [(0, 2), (1, 3), (3, 4), (4, 6), (5, 7), (7, 8), (8, 10),
+                 (9, 11), (12, 13)]
+
+_HEADING = re.compile(r'^\s*(\d+|[IVXLCDM]+)\s*$')
+
+
+def split_sonnets(text, n_lines=14):
+    '''
+    Splits a text of numbered sonnets into lists of lines. Headings (Arabic
+    or Roman numerals) and blank lines separate sonnets, and any sonnet that
+    does not have exactly n_lines lines is skipped.
+    '''
+
+    sonnets = []
+    sonnet = []
+
+    for line in text.split('\n') + ['']:
+        if line.strip() and not _HEADING.match(line):
+            sonnet.append(line.strip())
+            continue
+
+        if len(sonnet) == n_lines:
+            sonnets.append(sonnet)
+
+        sonnet = []
+
+    return sonnets
+
+
+class RhymeIndex:
+    '''
+    Union-find over observation indices whose classes are rhyming words.
+    '''
+
+    def __init__(self):
+        '''
+        Parameters:
+            members:    Flat integer array of every word in a class of at
+                        least two words, grouped by class.
+
+            offsets:    offsets[c]:offsets[c + 1] is the slice of members
+                        holding class c.
+
+            classes:    classes[i] is the class of members[i].
+
+            position:   Dictionary from word to its position in members.
+        '''
+
+        self._parent = {}
+        self._dirty = True
+
+        self.members = np.zeros(0, dtype=np.int32)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.classes = np.zeros(0, dtype=np.int64)
+        self.position = {}
+
+    def __len__(self):
+        self._build()
+        return len(self.members)
+
+    def _find(self, w):
+        parent = self._parent
+        root = w
+
+        while parent[root] != root:
+            root = parent[root]
+
+        # Path compression.
+        while parent[w] != root:
+            parent[w], w = root, parent[w]
+
+        return root
+
+    def add_pair(self, w1, w2):
+        '''
+        Records that observations w1 and w2 rhyme.
+        '''
+
+        for w in (w1, w2):
+            if w not in self._parent:
+                self._parent[w] = w
+
+        r1, r2 = self._find(w1), self._find(w2)
+
+        if r1 != r2:
+            self._parent[max(r1, r2)] = min(r1, r2)
+            self._dirty = True
+
+    def add_sonnet(self, end_words, pairs=SHAKESPEARE_PAIRS):
+        '''
+        Records the rhymes of one sonnet.
+
+        Arguments:
+            end_words:  Observation index of the last word of every line,
+                        or None for words outside the vocabulary.
+
+            pairs:      Positions of rhyming lines.
+        '''
+
+        for a, b in pairs:
+            if end_words[a] is not None and end_words[b] is not None:
+                self.add_pair(end_words[a], end_words[b])
+
+    def add_text(self, text, obs_map, pairs=SHAKESPEARE_PAIRS):
+        '''
+        Records the rhymes of every sonnet of a text, e.g. data/spenser.txt
+        with SPENSER_PAIRS. End words missing from obs_map are ignored.
+        '''
+
+        for sonnet in split_sonnets(text):
+            end_words = [obs_map.get(clean_word(line.split()[-1]))
+                         for line in sonnet]
+            self.add_sonnet(end_words, pairs)
+
+    def _build(self):
+        if not self._dirty:
+            return
+
+        words = np.array(sorted(self._parent), dtype=np.int32)
+        roots = np.array([self._find(w) for w in words], dtype=np.int64)
+
+        _, classes, sizes = np.unique(roots, return_inverse=True,
+                                      return_counts=True)
+
+        # Only classes with at least two words can give a rhyming pair.
+        keep = sizes[classes] >= 2
+        words, classes = words[keep], classes[keep]
+        _, classes, sizes = np.unique(classes, return_inverse=True,
+                                      return_counts=True)
+
+        order = np.argsort(classes, kind='stable')
+
+        self.members = words[order]
+        self.classes = classes[order]
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)])
+        self.position = {int(w): i for i, w in enumerate(self.members)}
+        self._dirty = False
+
+    def words(self):
+        '''
+        Returns every observation that rhymes with at least one other.
+        '''
+
+        self._build()
+        return self.members
+
+    def rhymes(self, w):
+        '''
+        Returns the observations that rhyme with w, excluding w itself.
+        '''
+
+        self._build()
+
+        if w not in self.position:
+            return np.zeros(0, dtype=np.int32)
+
+        c = self.classes[self.position[w]]
+        group = self.members[self.offsets[c]:self.offsets[c + 1]]
+
+        return group[group != w]
+
+    def sample_pair(self, rng=np.random):
+        '''
+        Draws a pair of distinct rhyming observations in constant time. The
+        first word is uniform over all rhymeable words and the second is
+        uniform over the other words of its class.
+        '''
+
+        pairs = self.sample_pairs(1, rng)
+        return int(pairs[0, 0]), int(pairs[0, 1])
+
+    def sample_pairs(self, n, rng=np.random):
+        '''
+        Draws n rhyming pairs at once. rng may be numpy's global random
+        state or a Generator.
+
+        Returns:
+            pairs:      Integer array of shape (n, 2).
+        '''
+
+        self._build()
+
+        if len(self.members) == 0:
+            raise ValueError('The rhyme index has no rhyming pairs.')
+
+        u = rng.random((n, 2))
+
+        i = (u[:, 0] * len(self.members)).astype(np.int64)
+        i = np.minimum(i, len(self.members) - 1)
+
+        c = self.classes[i]
+        start = self.offsets[c]
+        size = self.offsets[c + 1] - start
+
+        # Any other member of the class: skip 1 to size - 1 places ahead.
+        skip = 1 + np.minimum((u[:, 1] * (size - 1)).astype(np.int64),
+                              size - 2)
+        j = start + (i - start + skip) % size
+
+        return np.stack([self.members[i], self.members[j]], axis=1)
@@ -0,0 +1,223 @@
+########################################
+# Precomputed samplers for HiddenMarkovModel
+########################################
+
+# Drawing from a categorical distribution with np.random.choice rebuilds and
+# re-validates the probability vector and scans it on every call. The alias
+# method (Vose) pays O(N) once per distribution and then draws in O(1) from a
+# single uniform number.
+
+import numpy as np
+
+
+class AliasTable:
+    '''
+    Alias tables for every row of a matrix of (unnormalized) probabilities.
+    Rows that sum to zero are treated as uniform.
+    '''
+
+    def __init__(self, P):
+        '''
+        Arguments:
+            P:          Array of shape (R, N). Row r is the distribution
+                        sampled by draw(r, u).
+
+        Parameters:
+            prob:       Array of shape (R, N) of acceptance thresholds.
+
+            alias:      Integer array of shape (R, N) of the outcome used
+                        when the threshold is not met.
+        '''
+
+        P = np.asarray(P, dtype=float)
+
+        if P.ndim == 1:
+            P = P[None]
+
+        R, N = P.shape
+        self.N = N
+        self.prob = np.ones((R, N))
+        self.alias = np.tile(np.arange(N, dtype=np.int32), (R, 1))
+
+        totals = P.sum(axis=1)
+
+        for r in range(R):
+            if totals[r] > 0:
+                self._build_row(r, P[r] * (N / totals[r]))
+
+    def _build_row(self, r, scaled):
+        prob = self.prob[r]
+        alias = self.alias[r]
+
+        small = [i for i in range(self.N) if scaled[i] < 1.]
+        large = [i for i in range(self.N) if scaled[i] >= 1.]
+        scaled = scaled.tolist()
+
+        while small and large:
+            s = small.pop()
+            l = large[-1]
+
+            prob[s] = scaled[s]
+            alias[s] = l
+
+            scaled[l] -= 1. - scaled[s]
+
+            if scaled[l] < 1.:
+                small.append(large.pop())
+
+        # Whatever is left is 1 up to rounding error.
+        for i in small + large:
+            prob[i] = 1.
+
+    @property
+    def nbytes(self):
+        return self.prob.nbytes + self.alias.nbytes
+
+    def draw(self, r, u):
+        '''
+        Returns the outcome of row r for a uniform number u in [0, 1).
+        '''
+
+        scaled = u * self.N
+        i = min(int(scaled), self.N - 1)
+
+        if scaled - i < self.prob[r, i]:
+            return i
+
+        return int(self.alias[r, i])
+
+    def sample(self, r=0):
+        '''
+        Draws one outcome of row r from numpy's global random state.
+        '''
+
+        return self.draw(r, np.random.random_sample())
+
+
+class FittingTable:
+    '''
+    Samplers for every row of a matrix of (unnormalized) emission
+    probabilities restricted to the words that fit in r syllables, for every
+    r at once.
+
+    A word fits in r syllables if its smallest normal count is at most r,
+    or if one of its end-of-line counts is exactly r. The words are sorted
+    once by their smallest normal count, so that those fitting through a
+    normal count are a prefix of the order and share one cumulative table.
+    The few words that only fit through an end-of-line count get a small
+    table per r, built on first use.
+    '''
+
+    def __init__(self, P, index):
+        '''
+        Arguments:
+            P:          Array of shape (R, D). Row r is the distribution
+                        sampled by draw(r, ...).
+
+            index:      HMM_syllables.SyllableIndex of the D observations.
+
+        Parameters:
+            order:      The observations sorted by their smallest normal
+                        syllable count.
+
+            cum:        Array of shape (R, D + 1) of the running sums of P
+                        over order.
+        '''
+
+        P = np.asarray(P, dtype=float)
+
+        if P.ndim == 1:
+            P = P[None]
+
+        self.P = P
+        self._sort_words(index)
+
+        self.cum = np.zeros((len(P), len(self.order) + 1))
+        np.cumsum(P[:, self.order], axis=1, out=self.cum[:, 1:])
+
+    def _sort_words(self, index):
+        normal = np.where(index.normal > 0, index.normal, np.iinfo(np.int8).max)
+
+        self.index = index
+        self.key = normal.min(axis=1).astype(int)
+        self.order = np.argsort(self.key, kind='stable')
+        self._sorted_keys = self.key[self.order]
+        self._extras = {}
+
+    @property
+    def nbytes(self):
+        return (self.key.nbytes + self.order.nbytes + self._sorted_keys.nbytes
+                + self.cum.nbytes
+                + sum(words.nbytes + cum.nbytes
+                      for words, cum in self._extras.values()))
+
+    def bound(self, r):
+        '''
+        Number of words of the order that fit in r syllables through a
+        normal count.
+        '''
+
+        if r <= 0:
+            return 0
+
+        return int(np.searchsorted(self._sorted_keys, r, side='right'))
+
+    def extras(self, r):
+        '''
+        Returns the words that only fit in r syllables through an end-of-line
+        count, and the running sums of every row over them.
+        '''
+
+        if r not in self._extras:
+            counts = self.index.counts(r)
+            words = np.flatnonzero((counts > 0) & (self.key > r))
+
+            cum = np.zeros((self.cum.shape[0], len(words) + 1))
+            np.cumsum(self._columns(words), axis=1, out=cum[:, 1:])
+
+            self._extras[r] = (words, cum)
+
+        return self._extras[r]
+
+    def _columns(self, words):
+        return self.P[:, words]
+
+    def _prefix_mass(self, z, b):
+        return self.cum[z, b]
+
+    def _draw_prefix(self, z, b, target):
+        j = np.searchsorted(self.cum[z, 1:b + 1], target, side='right')
+
+        return int(self.order[min(j, b - 1)])
+
+    def draw(self, z, r, u):
+        '''
+        Returns a word of row z that fits in r syllables for a uniform number
+        u in [0, 1), or -1 if no such word has mass.
+        '''
+
+        b = self.bound(r)
+        words, cum = self.extras(r)
+
+        prefix = self._prefix_mass(z, b)
+        total = prefix + cum[z, -1]
+
+        if total <= 0:
+            return -1
+
+        target = u * total
+
+        if target < prefix or len(words) == 0:
+            return self._draw_prefix(z, b, target)
+
+        j = np.searchsorted(cum[z, 1:], target - prefix, side='right')
+
+        return int(words[min(j, len(words) - 1)])
+
+    def sample(self, z, r):
+        '''
+        Draws one word of row z that fits in r syllables from numpy's global
+        random state, or returns -1 if there is none.
+        '''
+
+        return self.draw(z, r, np.random.random_sample())
@@ -0,0 +1,527 @@
+########################################
+# Batched sonnet-generation server
+########################################
+
+# Loads a model, its vocabulary, syllable index and rhyme index once and
+# serves generation requests over TCP, one JSON object per line:
+#
+#     {"id": 1, "type": "sonnet"}
+#     {"id": 2, "type": "haiku"}
+#     {"id": 3, "type": "line", "syllables": 10, "seed": "love"}
+#
+# Every request gets one response line with the same id, either
+# {"id": ..., "lines": [...]} or {"id": ..., "error": "..."}. A connection
+# may send many requests without waiting; responses come back as they are
+# ready. Requests that arrive within a short window are gathered, and all
+# their lines are generated with one HiddenMarkovModel.generate_lines call
+# per line length.
+#
+# For the rhyming model of HMM_with_rhyme.ipynb, which generates lines back
+# to front from their last word:
+#
+#     python HMM_server.py serve --model hmm_rhyme.model --reversed \
+#         --corpus data/shakespeare_no99_no126.txt
+#
+# and to measure throughput and latency under concurrent load, against an
+# in-process server (or a running one with --connect HOST:PORT):
+#
+#     python HMM_server.py bench --model hmm_rhyme.model --reversed \
+#         --corpus data/shakespeare_no99_no126.txt --clients 64
+
+import sys
+import json
+import time
+import pickle
+import asyncio
+import argparse
+import concurrent.futures
+import numpy as np
+
+from HMM_corpus import parse_files
+from HMM_io import load_model, read_header
+from HMM_rhyme import RhymeIndex, SHAKESPEARE_PAIRS
+from HMM_syllables import SyllableIndex
+
+
+SONNET = [10] * 14
+HAIKU = [5, 7, 5]
+
+
+class Poet:
+    '''
+    A model with everything needed to turn requests into lines of text.
+    '''
+
+    def __init__(self, hmm, obs_map, syllables, rhymes=None, reversed=False,
+                 seed=None):
+        '''
+        Arguments:
+            hmm:        The HiddenMarkovModel.
+
+            obs_map:    Dictionary from word to observation index.
+
+            syllables:  HMM_syllables.SyllableIndex of the observations.
+
+            rhymes:     Optional HMM_rhyme.RhymeIndex. Sonnets rhyme only
+                        with a rhyme index and a reversed model.
+
+            reversed:   Whether the model generates lines back to front, so
+                        that a seed word is the last word of its line.
+
+            seed:       Seed of the random number generator.
+        '''
+
+        if len(obs_map) != hmm.D:
+            raise ValueError('The vocabulary has %d words but the model has '
+                             '%d observations.' % (len(obs_map), hmm.D))
+
+        self.hmm = hmm
+        self.obs_map = obs_map
+        self.words = [None] * len(obs_map)
+        for word, i in obs_map.items():
+            self.words[i] = word
+
+        self.syllables = syllables
+        self.rhymes = rhymes
+        self.reversed = reversed
+        self.rng = np.random.default_rng(seed)
+
+        # Build the lattice for the longest line up front, so that the first
+        # request does not pay for it.
+        self.hmm.syllable_lattice(self.words, self.syllables, max(SONNET))
+
+    @classmethod
+    def load(cls, model_path, obs_map_path=None, corpus_path=None,
+             reversed=False, dict_path='data/Syllable_dictionary.txt',
+             syllable_cache=None, seed=None):
+        '''
+        Loads a Poet from files.
+
+        Arguments:
+            model_path:     Model file written by HMM_io.save_model, or a
+                            pickled HiddenMarkovModel.
+
+            obs_map_path:   Pickled observation map, if the model file has
+                            no vocabulary.
+
+            corpus_path:    Sonnet text the model was trained on. It gives
+                            the rhyme index, and the observation map when
+                            there is no other, rebuilt the way
+                            HMM_with_rhyme.ipynb parses it.
+
+            reversed:       Whether the model generates lines back to front.
+
+            dict_path:      Syllable dictionary, if the model file has no
+                            syllable index.
+
+            syllable_cache: Optional .npz cache of the syllable index.
+
+            seed:           Seed of the random number generator.
+        '''
+
+        obs_map = syllables = None
+
+        try:
+            read_header(model_path)
+        except ValueError:
+            with open(model_path, 'rb') as f:
+                hmm = pickle.load(f)
+        else:
+            hmm, obs_map, syllables = load_model(model_path)
+
+        if obs_map is None and obs_map_path is not None:
+            with open(obs_map_path, 'rb') as f:
+                obs_map = pickle.load(f)
+
+        if obs_map is None:
+            if corpus_path is None:
+                raise ValueError('The model has no vocabulary; give an '
+                                 'observation map or the corpus.')
+
+            _, obs_map = parse_files([corpus_path], keep_apostrophes=True,
+                                     reverse=reversed)
+
+        if syllables is None:
+            syllables = SyllableIndex.build(obs_map, dict_path,
+                                            syllable_cache)
+
+        rhymes = None
+        if corpus_path is not None:
+            rhymes = RhymeIndex()
+            with open(corpus_path) as f:
+                rhymes.add_text(f.read(), obs_map)
+
+        return cls(hmm, obs_map, syllables, rhymes, reversed, seed)
+
+    def jobs(self, request):
+        '''
+        Turns a request into a list of (syllables, seed word index or None),
+        one per line to generate. Raises ValueError for bad requests.
+        '''
+
+        if not isinstance(request, dict):
+            raise ValueError('A request must be a JSON object.')
+
+        kind = request.get('type')
+
+        if kind == 'haiku':
+            return [(M, None) for M in HAIKU]
+
+        if kind == 'sonnet':
+            return list(zip(SONNET, self._sonnet_seeds()))
+
+        if kind == 'line':
+            M = request.get('syllables', 10)
+
+            if isinstance(M, bool) or not isinstance(M, int) \
+                    or not 0 < M <= 20:
+                raise ValueError('syllables must be an integer between 1 '
+                                 'and 20.')
+
+            seed = request.get('seed')
+
+            if seed is None:
+                return [(M, None)]
+
+            if not isinstance(seed, str):
+                raise ValueError('seed must be a word.')
+
+            w = self.obs_map.get(seed.lower())
+
+            if w is None:
+                raise ValueError('Unknown word %r.' % seed)
+
+            if self.syllables.counts(M)[w] <= 0:
+                raise ValueError('%r does not fit in %d syllables.' % (seed, M))
+
+            return [(M, w)]
+
+        raise ValueError('Unknown request type %r.' % kind)
+
+    def _sonnet_seeds(self):
+        '''
+        Returns the last word of every sonnet line, following the rhyme
+        scheme, or Nones if the model cannot place end words.
+        '''
+
+        if self.rhymes is None or not self.reversed:
+            return [None] * len(SONNET)
+
+        fits = self.syllables.counts(max(SONNET)) > 0
+        pairs = self.rhymes.sample_pairs(len(SHAKESPEARE_PAIRS), self.rng)
+
+        # Redraw the few pairs with a word that cannot end a line.
+        while True:
+            bad = ~(fits[pairs[:, 0]] & fits[pairs[:, 1]])
+            if not bad.any():
+                break
+            pairs[bad] = self.rhymes.sample_pairs(int(bad.sum()), self.rng)
+
+        seeds = [None] * len(SONNET)
+        for (a, b), (w1, w2) in zip(SHAKESPEARE_PAIRS, pairs.tolist()):
+            seeds[a], seeds[b] = w1, w2
+
+        return seeds
+
+    def generate(self, jobs):
+        '''
+        Generates one line of text per job, with one generate_lines call per
+        line length and kind of seeding.
+        '''
+
+        groups = {}
+        for i, (M, seed) in enumerate(jobs):
+            groups.setdefault((M, seed is not None), []).append(i)
+
+        lines = [None] * len(jobs)
+
+        for (M, seeded), idx in groups.items():
+            seeds = [jobs[i][1] for i in idx] if seeded else None
+            emissions, _ = self.hmm.generate_lines(
+                len(idx), M, self.words, self.syllables, seeds, self.rng)
+
+            for i, emission in zip(idx, emissions):
+                lines[i] = self.format_line(emission)
+
+        return lines
+
+    def format_line(self, emission):
+        words = [self.words[w] for w in emission]
+
+        if self.reversed:
+            words.reverse()
+
+        line = ' '.join(words)
+
+        return line[:1].upper() + line[1:]
+
+
+class Server:
+    '''
+    Line-oriented JSON server that batches the requests of a short window.
+    '''
+
+    def __init__(self, poet, window=0.005, max_lines=4096):
+        '''
+        Arguments:
+            poet:       The Poet that generates lines.
+
+            window:     Seconds to wait for more requests before generating.
+
+            max_lines:  Number of pending lines that triggers generation
+                        without waiting for the window to end.
+
+        Parameters:
+            batches:    Number of generation calls so far.
+
+            lines:      Number of lines generated so far.
+        '''
+
+        self.poet = poet
+        self.window = window
+        self.max_lines = max_lines
+
+        self.batches = 0
+        self.lines = 0
+
+        self._pending = []
+        self._n_pending = 0
+        self._timer = None
+
+        # Generation runs on one worker thread, so the event loop keeps
+        # accepting requests while a batch is generated.
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    async def start(self, host='127.0.0.1', port=8155):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+        self._executor.shutdown()
+
+    async def submit(self, request):
+        '''
+        Queues a request and returns its lines once its batch is generated.
+        '''
+
+        jobs = self.poet.jobs(request)
+        future = asyncio.get_running_loop().create_future()
+
+        self._pending.append((jobs, future))
+        self._n_pending += len(jobs)
+
+        if self._n_pending >= self.max_lines:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window,
+                                                                self._flush)
+
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        pending, self._pending, self._n_pending = self._pending, [], 0
+
+        if pending:
+            asyncio.ensure_future(self._generate(pending))
+
+    async def _generate(self, pending):
+        jobs = [job for request_jobs, _ in pending for job in request_jobs]
+
+        try:
+            lines = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self.poet.generate, jobs)
+        except Exception as error:
+            if len(pending) == 1:
+                pending[0][1].set_exception(error)
+            else:
+                # Retry one request at a time, so that only the request
+                # that fails gets the error.
+                for request in pending:
+                    await self._generate([request])
+            return
+
+        self.batches += 1
+        self.lines += len(jobs)
+
+        start = 0
+        for request_jobs, future in pending:
+            future.set_result(lines[start:start + len(request_jobs)])
+            start += len(request_jobs)
+
+    async def _handle(self, reader, writer):
+        tasks = set()
+
+        while True:
+            data = await reader.readline()
+
+            if not data:
+                break
+
+            task = asyncio.ensure_future(self._respond(data, writer))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            await asyncio.wait(tasks)
+
+        writer.close()
+
+    async def _respond(self, data, writer):
+        request_id = None
+
+        try:
+            request = json.loads(data)
+
+            if isinstance(request, dict):
+                request_id = request.get('id')
+
+            response = {'id': request_id, 'lines': await self.submit(request)}
+        except Exception as error:
+            # Every request gets an answer, whatever went wrong with it.
+            response = {'id': request_id, 'error': str(error)}
+
+        writer.write(json.dumps(response).encode('utf-8') + b'\n')
+        await writer.drain()
+
+
+####################
+# LOAD TEST
+####################
+
+async def load_test(host, port, clients=32, requests=2000,
+                    mix=('sonnet', 'haiku', 'line')):
+    '''
+    Sends requests from concurrent clients, each waiting for a response
+    before sending its next request, and measures every request's latency.
+
+    Returns:
+        report:     Dictionary with the number of requests and lines, errors,
+                    wall time, throughput and latency percentiles.
+    '''
+
+    latencies = []
+    errors = 0
+    lines = 0
+    counter = iter(range(requests))
+
+    async def client():
+        nonlocal errors, lines
+
+        reader, writer = await asyncio.open_connection(host, port)
+
+        for i in counter:
+            request = {'id': i, 'type': mix[i % len(mix)]}
+
+            start = time.perf_counter()
+            writer.write(json.dumps(request).encode('utf-8') + b'\n')
+            response = json.loads(await reader.readline())
+            latencies.append(time.perf_counter() - start)
+
+            if 'error' in response:
+                errors += 1
+            else:
+                lines += len(response['lines'])
+
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(clients)])
+    seconds = time.perf_counter() - start
+
+    latencies = np.array(latencies) * 1e3
+
+    return {
+        'requests': len(latencies),
+        'lines': lines,
+        'errors': errors,
+        'seconds': seconds,
+        'requests_per_second': len(latencies) / seconds,
+        'lines_per_second': lines / seconds,
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'max_ms': float(latencies.max()),
+    }
+
+
+async def _bench(args):
+    server = None
+
+    if args.connect is not None:
+        host, port = args.connect.rsplit(':', 1)
+    else:
+        server = Server(_load(args), args.window)
+        host, port = await server.start(args.host, 0)
+
+    report = await load_test(host, int(port), args.clients, args.requests,
+                             args.mix.split(','))
+
+    if server is not None:
+        report['batches'] = server.batches
+        report['lines_per_batch'] = server.lines / max(server.batches, 1)
+        await server.close()
+
+    print(json.dumps(report, indent=2))
+
+
+async def _serve(args):
+    server = Server(_load(args), args.window)
+    host, port = await server.start(args.host, args.port)
+    print('Serving on %s:%d' % (host, port))
+
+    await server._server.serve_forever()
+
+
+def _load(args):
+    return Poet.load(args.model, args.obs_map, args.corpus, args.reversed,
+                     args.syllables, args.syllable_cache, args.seed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Serve batched sonnet generation over TCP.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve = commands.add_parser('serve', help='run the server')
+    bench = commands.add_parser('bench', help='run a load test')
+
+    for command in (serve, bench):
+        command.add_argument('--model', default='hmm_rhyme.model')
+        command.add_argument('--obs-map')
+        command.add_argument('--corpus',
+                             help='training sonnets, for rhymes and the '
+                                  'vocabulary of models without one')
+        command.add_argument('--reversed', action='store_true',
+                             help='the model generates lines back to front')
+        command.add_argument('--syllables',
+                             default='data/Syllable_dictionary.txt')
+        command.add_argument('--syllable-cache')
+        command.add_argument('--seed', type=int)
+        command.add_argument('--host', default='127.0.0.1')
+        command.add_argument('--window', type=float, default=0.005,
+                             help='seconds to gather requests')
+
+    serve.add_argument('--port', type=int, default=8155)
+
+    bench.add_argument('--connect', metavar='HOST:PORT',
+                       help='test a running server instead')
+    bench.add_argument('--clients', type=int, default=32)
+    bench.add_argument('--requests', type=int, default=2000)
+    bench.add_argument('--mix', default='sonnet,haiku,line',
+                       help='comma-separated request types, sent in turn')
+
+    args = parser.parse_args(argv)
+
+    try:
+        asyncio.run(_serve(args) if args.command == 'serve' else _bench(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,365 @@
+########################################
+# Sparse emission matrices for HiddenMarkovModel
+########################################
+
+# After training, most of the mass of each row of O sits on a few hundred
+# words. TopKEmissions keeps only the k most likely words of every state
+# and spreads the remaining mass uniformly over the other D - k words (the
+# residual bucket). HiddenMarkovModel accepts one in place of a dense O for
+# forward/backward, Viterbi and generation.
+
+import copy
+import time
+import numpy as np
+
+from HMM_sampling import AliasTable, FittingTable
+
+
+class TopKEmissions:
+    '''
+    Top-k per state observation matrix with a residual bucket.
+    '''
+
+    def __init__(self, indices, values, D):
+        '''
+        Arguments:
+            indices:    Integer array of shape (L, k). Row i holds the
+                        observations kept for state i in increasing order.
+
+            values:     Array of shape (L, k) of the emission probabilities
+                        of those observations.
+
+            D:          Number of observations.
+
+        Parameters:
+            residual:   Array of length L. The i^th element is the
+                        probability of each observation of state i that is
+                        not among its top k.
+        '''
+
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.values = np.asarray(values, dtype=float)
+        self.D = D
+
+        L, k = self.indices.shape
+        rest = np.clip(1. - self.values.sum(axis=1), 0., None)
+        self.residual = rest / (D - k) if D > k else np.zeros(L)
+
+        # Sorted keys state * D + observation, used to look up columns of
+        # every state at once.
+        self._keys = (np.arange(L)[:, None] * D + self.indices).ravel()
+
+        # Probability of each entry of a row plus the residual bucket, and
+        # the offsets that map the r^th non-top observation to its index.
+        self._row_probs = np.hstack([self.values, rest[:, None]])
+        self._gaps = self.indices - np.arange(k)
+
+        # Alias table over the k + 1 entries of each row, built on the
+        # first draw.
+        self._alias = None
+
+    @classmethod
+    def from_dense(cls, O, k):
+        '''
+        Builds a top-k representation of a dense L x D observation matrix.
+        '''
+
+        O = np.asarray(O, dtype=float)
+        L, D = O.shape
+        k = min(k, D)
+
+        top = np.argpartition(-O, k - 1, axis=1)[:, :k] if k < D else \
+            np.tile(np.arange(D), (L, 1))
+        top.sort(axis=1)
+
+        return cls(top, np.take_along_axis(O, top, axis=1), D)
+
+    @property
+    def shape(self):
+        return (len(self.indices), self.D)
+
+    @property
+    def nbytes(self):
+        return (self.indices.nbytes + self.values.nbytes
+                + self.residual.nbytes + self._keys.nbytes
+                + self._row_probs.nbytes + self._gaps.nbytes)
+
+    def columns(self, x):
+        '''
+        Equivalent of O[:, x] for a dense matrix: returns an array of shape
+        (L,) + shape(x).
+        '''
+
+        x = np.asarray(x)
+        L = len(self.indices)
+
+        keys = np.arange(L).reshape((L,) + (1,) * x.ndim) * self.D + x
+        pos = np.searchsorted(self._keys, keys)
+        pos = np.minimum(pos, len(self._keys) - 1)
+        hit = self._keys[pos] == keys
+
+        out = np.broadcast_to(
+            self.residual.reshape((L,) + (1,) * x.ndim), keys.shape).copy()
+        out[hit] = self.values.ravel()[pos[hit]]
+
+        return out
+
+    def row(self, state):
+        '''
+        Dense emission probabilities of a single state.
+        '''
+
+        row = np.full(self.D, self.residual[state])
+        row[self.indices[state]] = self.values[state]
+
+        return row
+
+    def toarray(self):
+        return np.vstack([self.row(i) for i in range(len(self.indices))])
+
+    def sample(self, state):
+        '''
+        Draws one observation from the given state.
+        '''
+
+        if self._alias is None:
+            self._alias = AliasTable(self._row_probs)
+
+        k = self.indices.shape[1]
+        j = self._alias.sample(state)
+
+        if j < k:
+            return int(self.indices[state, j])
+
+        return self.residual_word(state, np.random.randint(self.D - k))
+
+    def residual_word(self, state, r):
+        '''
+        Returns the r^th observation (in increasing order) that is not among
+        the top k of the given state.
+        '''
+
+        return int(r + np.searchsorted(self._gaps[state], r, side='right'))
+
+
+class TopKFittingTable(FittingTable):
+    '''
+    FittingTable of a TopKEmissions. Every state keeps a cumulative table
+    over its top k words only, in the syllable order, and the other words
+    that fit share one residual entry of weight residual[state] times their
+    number. A draw that lands on it picks one of them uniformly.
+    '''
+
+    def __init__(self, O, index):
+        '''
+        Arguments:
+            O:          A TopKEmissions.
+
+            index:      HMM_syllables.SyllableIndex of the observations.
+
+        Parameters:
+            positions:  Integer array of shape (L, k). Row z holds the
+                        positions in order of the top k words of state z,
+                        in increasing order.
+
+            cum:        Array of shape (L, k + 1) of the running sums of
+                        their probabilities.
+        '''
+
+        self.O = O
+        self._sort_words(index)
+
+        rank = np.empty(O.D, dtype=int)
+        rank[self.order] = np.arange(O.D)
+
+        positions = rank[O.indices]
+        by_position = np.argsort(positions, axis=1)
+        k = positions.shape[1]
+
+        self.positions = np.take_along_axis(positions, by_position, axis=1)
+        self.cum = np.zeros((len(positions), k + 1))
+        np.cumsum(np.take_along_axis(O.values, by_position, axis=1), axis=1,
+                  out=self.cum[:, 1:])
+
+        # As in TopKEmissions, the offsets that map the j^th position that
+        # is not a top word of the state to its position.
+        self._gaps = self.positions - np.arange(k)
+
+    @property
+    def nbytes(self):
+        return (FittingTable.nbytes.fget(self) + self.positions.nbytes
+                + self._gaps.nbytes)
+
+    def _columns(self, words):
+        return self.O.columns(words)
+
+    def _prefix_mass(self, z, b):
+        n = np.searchsorted(self.positions[z], b)
+
+        return self.cum[z, n] + self.O.residual[z] * (b - n)
+
+    def _draw_prefix(self, z, b, target):
+        n = np.searchsorted(self.positions[z], b)
+
+        if target < self.cum[z, n] or n == b:
+            j = np.searchsorted(self.cum[z, 1:n + 1], target, side='right')
+            return int(self.order[self.positions[z, min(j, n - 1)]])
+
+        j = np.random.randint(b - n)
+
+        return int(self.order[j + np.searchsorted(self._gaps[z], j,
+                                                  side='right')])
+
+
+def sparsify(hmm, k):
+    '''
+    Returns a shallow copy of hmm whose observation matrix is replaced by
+    its top-k representation.
+    '''
+
+    sparse = copy.copy(hmm)
+    sparse.O = TopKEmissions.from_dense(hmm.O, k)
+    sparse._caches = {}
+
+    return sparse
+
+
+def _nbytes(obj, seen):
+    '''
+    Bytes of the numpy arrays reachable from obj that are not in seen,
+    following lists, tuples, dictionaries and object attributes. Every
+    array is added to seen, so that shared arrays count once.
+    '''
+
+    if id(obj) in seen:
+        return 0
+
+    seen.add(id(obj))
+
+    if isinstance(obj, np.ndarray):
+        if isinstance(obj.base, np.ndarray):
+            return _nbytes(obj.base, seen)
+
+        return obj.nbytes
+
+    if isinstance(obj, dict):
+        obj = list(obj.values())
+    elif hasattr(obj, '__dict__'):
+        obj = list(vars(obj).values())
+
+    if isinstance(obj, (list, tuple)):
+        return sum(_nbytes(item, seen) for item in obj)
+
+    return 0
+
+
+def compare_emissions(hmm, ks=(50, 200, 500), n_draws=2000, seq_len=10,
+                      n_seqs=200, inv_obs_map=None, syllables=None,
+                      show=True):
+    '''
+    Reports memory use and latency of the dense observation matrix of hmm
+    against top-k representations for every k in ks.
+
+    Arguments:
+        hmm:        A trained HiddenMarkovModel with a dense O.
+
+        ks:         Values of k to compare.
+
+        n_draws:    Number of emission draws to time.
+
+        seq_len:    Length of the random sequences scored with forward().
+
+        n_seqs:     Number of sequences scored.
+
+        inv_obs_map: Optional dictionary from observation index to word.
+                    With syllables, every model then also generates one
+                    line with each sonnet generator, and the size of what
+                    they cache on the model is reported.
+
+        syllables:  HMM_syllables.SyllableIndex of the observations.
+
+        show:       Whether to print the table.
+
+    Returns:
+        rows:       List of dictionaries with the representation name, its
+                    size in bytes including the alias tables used for
+                    sampling, the retained emission mass, and the mean
+                    time in microseconds of one draw and of one forward
+                    pass. With inv_obs_map and syllables, 'generation_nbytes'
+                    is the size of O and of everything cached on the model
+                    after generating.
+    '''
+
+    rng = np.random.RandomState(0)
+    X = rng.randint(hmm.D, size=(n_seqs, seq_len))
+    states = rng.randint(hmm.L, size=n_draws)
+    generate = inv_obs_map is not None and syllables is not None
+
+    models = [('dense', hmm)]
+    models += [('top-%d' % k, sparsify(hmm, k)) for k in ks]
+
+    rows = []
+
+    for name, model in models:
+        O = model.O
+
+        # One untimed draw and forward pass, so that neither timing includes
+        # building the alias tables or other caches.
+        model.sample_emission(states[0])
+        model.forward_scaled(X[0])
+
+        if isinstance(O, TopKEmissions):
+            sampler = O._alias
+        else:
+            sampler = model._cached('O', O, AliasTable)
+
+        start = time.perf_counter()
+        for state in states:
+            model.sample_emission(state)
+        draw = (time.perf_counter() - start) / n_draws
+
+        start = time.perf_counter()
+        for x in X:
+            model.forward_scaled(x)
+        forward = (time.perf_counter() - start) / n_seqs
+
+        if isinstance(O, TopKEmissions):
+            mass = np.mean(O.values.sum(axis=1))
+        else:
+            mass = 1.
+
+        row = {
+            'representation': name,
+            'nbytes': int(O.nbytes + sampler.nbytes),
+            'top_mass': float(mass),
+            'sample_us': draw * 1e6,
+            'forward_us': forward * 1e6,
+        }
+
+        if generate:
+            seed = int(np.argmax(syllables.counts(10) > 0))
+            model.generate_sonnet_emission(10, inv_obs_map, syllables)
+            model.generate_sonnet_rhyme_emission(10, seed, inv_obs_map,
+                                                 syllables)
+            model.generate_exact_emission(10, inv_obs_map, syllables)
+
+            # The cache values only; A and the syllable index are not part
+            # of the representation.
+            seen = set()
+            _nbytes((model.A, model.A_start, syllables), seen)
+            row['generation_nbytes'] = _nbytes(
+                (O, [value for _, value in model._caches.values()]), seen)
+
+        rows.append(row)
+
+    if show:
+        print('%-14s %12s %9s %11s %11s%s' % (
+            'representation', 'bytes', 'top mass', 'draw (us)', 'fwd (us)',
+            ' %14s' % 'after gen' if generate else ''))
+        for row in rows:
+            print('%-14s %12d %9.4f %11.2f %11.2f%s' % (
+                row['representation'], row['nbytes'], row['top_mass'],
+                row['sample_us'], row['forward_us'],
+                ' %14d' % row['generation_nbytes'] if generate else ''))
+
+    return rows
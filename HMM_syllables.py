@@ -0,0 +1,244 @@
+########################################
+# Compiled syllable index for sonnet generation
+########################################
+
+# The notebooks parse data/Syllable_dictionary.txt into a dictionary from
+# word to [normal counts, end-of-line counts] (both in decreasing order), and
+# HiddenMarkovModel.get_syllables falls back to pyphen for words that are
+# missing. SyllableIndex compiles the same information into small integer
+# arrays aligned with an observation map, so that the sonnet emitters can
+# look up every word at once, and caches them on disk.
+
+import os
+import re
+import hashlib
+import functools
+import numpy as np
+import pyphen
+
+
+_STRIP = re.compile('^[^a-zA-Z]*|[^a-zA-Z]*$')
+
+_dic = None
+
+
+def pyphen_syllables(word):
+    '''
+    Counts the syllables of a word with pyphen. The hyphenation dictionary
+    is loaded once, and results are memoized.
+    '''
+
+    return _pyphen_syllables(word.lower())
+
+
+@functools.lru_cache(maxsize=None)
+def _pyphen_syllables(word):
+    global _dic
+
+    if _dic is None:
+        _dic = pyphen.Pyphen(lang='en')
+
+    return len(_dic.inserted(word).split('-'))
+
+
+def clean_word(word):
+    '''
+    Strips non-letters from both ends of a word and lowercases it, as
+    get_syllables does before a lookup.
+    '''
+
+    return _STRIP.sub('', word).lower()
+
+
+def load_syllable_dict(path='data/Syllable_dictionary.txt'):
+    '''
+    Parses the syllable dictionary into {word: [normal, end]}, where normal
+    and end are the normal and end-of-line syllable counts of the word in
+    decreasing order.
+    '''
+
+    syllable_dict = {}
+
+    with open(path) as f:
+        for line in f:
+            line = line.split()
+
+            if not line:
+                continue
+
+            real, end = [], []
+            for count in line[1:]:
+                if count[0] == 'E':
+                    end.append(int(count[1:]))
+                else:
+                    real.append(int(count))
+
+            syllable_dict[line[0]] = [real[::-1], end[::-1]]
+
+    return syllable_dict
+
+
+class SyllableIndex:
+    '''
+    Syllable counts of every observation of a model, keyed by observation
+    index.
+    '''
+
+    def __init__(self, normal, end, vocab_hash=''):
+        '''
+        Arguments:
+            normal:     Integer array of shape (D, K). Row w holds the
+                        normal syllable counts of word w in decreasing
+                        order, padded with zeros.
+
+            end:        Integer array of shape (D, K'), the same for the
+                        end-of-line counts.
+
+            vocab_hash: Digest of the vocabulary the index was built for.
+        '''
+
+        self.normal = np.asarray(normal, dtype=np.int8)
+        self.end = np.asarray(end, dtype=np.int8)
+        self.vocab_hash = vocab_hash
+        self._counts = {}
+
+    def __len__(self):
+        return len(self.normal)
+
+    @classmethod
+    def from_dictionary(cls, inv_obs_map, syl_dict, D=None, stats=None):
+        '''
+        Compiles a syllable dictionary for the words of an observation map.
+        Words missing from the dictionary are counted with pyphen once and
+        stored as their only normal count.
+
+        Arguments:
+            inv_obs_map:    Dictionary (or list) from observation index to
+                            word.
+
+            syl_dict:       Syllable dictionary as returned by
+                            load_syllable_dict.
+
+            D:              Number of observations. Defaults to the size
+                            of inv_obs_map.
+
+            stats:          Optional HMM_profile.Stats that counts the
+                            pyphen fallbacks.
+        '''
+
+        if D is None:
+            D = len(inv_obs_map)
+
+        words = [inv_obs_map[w] for w in range(D)]
+        normal, end = [], []
+
+        for word in words:
+            word = clean_word(word)
+
+            if word in syl_dict:
+                n, e = syl_dict[word]
+            else:
+                n, e = [pyphen_syllables(word)], []
+
+                if stats is not None:
+                    stats.count('pyphen_fallbacks')
+
+            normal.append(n)
+            end.append(e)
+
+        return cls(_pad(normal), _pad(end), vocabulary_hash(words))
+
+    @classmethod
+    def build(cls, obs_map, dict_path='data/Syllable_dictionary.txt',
+              cache_path=None):
+        '''
+        Returns the syllable index of an observation map, loading it from
+        cache_path when the cached index was built for the same vocabulary,
+        and compiling and saving it there otherwise.
+
+        Arguments:
+            obs_map:    Dictionary from word to observation index.
+
+            dict_path:  Path of the syllable dictionary.
+
+            cache_path: Path of the compiled .npz cache, or None.
+        '''
+
+        inv_obs_map = {v: k for k, v in obs_map.items()}
+        digest = vocabulary_hash([inv_obs_map[w] for w in range(len(obs_map))])
+
+        if cache_path is not None and os.path.exists(cache_path):
+            index = cls.load(cache_path)
+
+            if index.vocab_hash == digest:
+                return index
+
+        index = cls.from_dictionary(inv_obs_map, load_syllable_dict(dict_path))
+
+        if cache_path is not None:
+            index.save(cache_path)
+
+        return index
+
+    def save(self, path):
+        # Through a file object, np.savez keeps path as given instead of
+        # appending .npz, so build finds the cache under the same name.
+        with open(path, 'wb') as f:
+            np.savez(f, normal=self.normal, end=self.end,
+                     vocab_hash=np.array(self.vocab_hash))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['normal'], data['end'], str(data['vocab_hash']))
+
+    def syllables(self, w, rem_num_syl):
+        '''
+        Equivalent of HiddenMarkovModel.get_syllables for observation w.
+        '''
+
+        return int(self.counts(rem_num_syl)[w])
+
+    def counts(self, rem_num_syl):
+        '''
+        Returns an integer array of length D with the syllable count of every
+        word when rem_num_syl syllables remain: the largest normal count that
+        fits, or else an end-of-line count equal to rem_num_syl, or -1 if the
+        word does not fit.
+        '''
+
+        if rem_num_syl not in self._counts:
+            fits = (self.normal > 0) & (self.normal <= rem_num_syl)
+            first = fits.argmax(axis=1)
+
+            counts = np.where(fits.any(axis=1),
+                              self.normal[np.arange(len(self)), first], -1)
+
+            at_end = (self.end == rem_num_syl).any(axis=1) & (counts == -1)
+            counts[at_end] = rem_num_syl
+
+            if rem_num_syl <= 0:
+                counts[:] = -1
+
+            self._counts[rem_num_syl] = counts.astype(int)
+
+        return self._counts[rem_num_syl]
+
+
+def vocabulary_hash(words):
+    '''
+    Digest of an ordered vocabulary, used to check that a cached index
+    matches an observation map.
+    '''
+
+    return hashlib.sha1('\n'.join(words).encode('utf-8')).hexdigest()
+
+
+def _pad(rows):
+    width = max([len(row) for row in rows] + [1])
+    out = np.zeros((len(rows), width), dtype=np.int8)
+
+    for i, row in enumerate(rows):
+        out[i, :len(row)] = row
+
+    return out
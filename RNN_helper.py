@@ -0,0 +1,417 @@
+########################################
+# Character-level LSTM training data and decoding
+########################################
+
+# Training: RNN_generation.ipynb one-hot encodes every 41-character window
+# of the corpus up front, which takes hundreds of MB for a 100 KB text.
+# load_corpus keeps the corpus as one small integer array instead, and
+# CharWindows serves batches of windows from strided views of it, one-hot
+# encoded (or left as indices for an Embedding layer) per batch, with
+# integer targets:
+#
+#     corpus, mapping = load_corpus(['data/shakespeare_no99_no126.txt'])
+#     windows = CharWindows(corpus, len(mapping))
+#     model.compile(loss='sparse_categorical_crossentropy', optimizer='adam')
+#     model.fit(windows, epochs=100)
+#
+# Decoding: generate_seq in RNN_generation.ipynb re-encodes, pads and
+# one-hot encodes the last 40 characters and runs the whole LSTM over them
+# for every new character. LSTMDecoder instead copies the weights of the
+# trained model and steps the LSTM one character at a time in numpy,
+# carrying its hidden and cell state, so each character costs one step for
+# every line being generated:
+#
+#     decoder = LSTMDecoder.from_keras('rnn_model/lstm_shakespeare.h5',
+#                                      'rnn_model/shakespeare_mapping.pkl')
+#     poems = decoder.generate(["shall i compare thee to a summer's day?\n"],
+#                              1200, temperature=0.75)
+#
+# A one-hot input times the input kernel is one row of the kernel, so inputs
+# are looked up instead of encoded. The temperature divides the logits of the
+# output layer before the softmax; no model has to be rebuilt for it.
+#
+# The model was trained on windows of 40 characters, while the decoder keeps
+# the state of the whole text. With window set, the state is instead rebuilt
+# from the last window characters every window steps, which stays closer to
+# the training conditions at a fraction of the cost of generate_seq.
+
+import re
+import pickle
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+try:
+    from keras.utils import Sequence
+except ImportError:
+    # Without Keras, CharWindows is still a plain indexable batch source.
+    Sequence = object
+
+
+def clean_text(text):
+    '''
+    Cleans a text as RNN_generation.ipynb does before training: digits
+    removed, lowercased, stripped, and runs of blank lines collapsed.
+    '''
+
+    text = ''.join(filter(lambda x: not x.isdigit(), text))
+    text = text.lower().strip()
+
+    return re.sub(r'(\n\s*)+\n', '\n\n', text)
+
+
+def load_corpus(paths, mapping=None):
+    '''
+    Reads, cleans and encodes text files into one integer array.
+
+    Arguments:
+        paths:      Paths of the text files. Their texts are joined with a
+                    blank line.
+
+        mapping:    Dictionary from character to index, e.g. of a trained
+                    model, or None to build one from the sorted characters
+                    of the texts as the notebook does.
+
+    Returns:
+        corpus:     The encoded text, as uint8 if there are at most 256
+                    characters.
+
+        mapping:    The dictionary from character to index.
+    '''
+
+    texts = []
+    for path in paths:
+        with open(path) as f:
+            texts.append(clean_text(f.read()))
+
+    text = '\n\n'.join(texts)
+
+    if mapping is None:
+        mapping = dict((c, i) for i, c in enumerate(sorted(set(text))))
+
+    missing = set(text) - set(mapping)
+    if missing:
+        raise ValueError('Characters missing from the mapping: %r.'
+                         % ''.join(sorted(missing)))
+
+    # Encode through a lookup table indexed by code point.
+    codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+    lookup = np.zeros(max(ord(c) for c in mapping) + 1,
+                      dtype=np.uint8 if len(mapping) <= 256 else np.int32)
+    for char, i in mapping.items():
+        lookup[ord(char)] = i
+
+    return lookup[codes], mapping
+
+
+class CharWindows(Sequence):
+    '''
+    Batches of (window, next character) pairs over an encoded corpus, for
+    model.fit. Every offset of the corpus gives one window, as in the
+    notebook, but windows are strided views of the corpus and only one
+    batch at a time is copied and encoded.
+    '''
+
+    def __init__(self, corpus, n_chars, seq_length=40, batch_size=128,
+                 one_hot=True, shuffle=True, seed=None):
+        '''
+        Arguments:
+            corpus:         Integer array of the encoded text.
+
+            n_chars:        Number of distinct characters, V.
+
+            seq_length:     Characters per input window.
+
+            batch_size:     Windows per batch.
+
+            one_hot:        Whether inputs are one-hot, of shape
+                            (B, seq_length, V), for the notebook's model,
+                            or indices of shape (B, seq_length) for a model
+                            that starts with an Embedding layer.
+
+            shuffle:        Whether to visit the windows in a new random
+                            order every epoch.
+
+            seed:           Seed of the shuffling.
+        '''
+
+        self.corpus = np.asarray(corpus)
+        self.windows = sliding_window_view(self.corpus, seq_length + 1)
+        self.n_chars = n_chars
+        self.batch_size = batch_size
+        self.one_hot = one_hot
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+
+        self._eye = np.eye(n_chars, dtype=np.float32)
+        self._order = None
+        self.on_epoch_end()
+
+    def __len__(self):
+        return -(-len(self.windows) // self.batch_size)
+
+    def __getitem__(self, i):
+        '''
+        Returns batch i as (inputs, targets), where targets are the integer
+        indices of the next characters, for a sparse categorical loss.
+        '''
+
+        start = i * self.batch_size
+        end = min(start + self.batch_size, len(self.windows))
+
+        if self._order is None:
+            batch = self.windows[start:end]
+        else:
+            batch = self.windows[self._order[start:end]]
+
+        X = batch[:, :-1]
+        y = batch[:, -1].astype(np.int32)
+
+        if self.one_hot:
+            X = self._eye[X]
+
+        return X, y
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            dtype = np.int32 if len(self.windows) < 2 ** 31 else np.int64
+            self._order = self.rng.permutation(len(self.windows)).astype(dtype)
+
+
+class LSTMDecoder:
+    '''
+    Stateful decoder for a Keras LSTM followed by a softmax Dense layer.
+    '''
+
+    def __init__(self, kernel, recurrent_kernel, bias, dense_kernel,
+                 dense_bias, mapping, recurrent_activation='sigmoid'):
+        '''
+        Arguments:
+            kernel:                 LSTM input kernel, of shape (V, 4H).
+
+            recurrent_kernel:       LSTM recurrent kernel, of shape (H, 4H).
+
+            bias:                   LSTM bias, of length 4H.
+
+            dense_kernel:           Output kernel, of shape (H, V).
+
+            dense_bias:             Output bias, of length V.
+
+            mapping:                Dictionary from character to index.
+
+            recurrent_activation:   'sigmoid', or 'hard_sigmoid' for models
+                                    trained with the default of Keras
+                                    versions before 2.3.
+
+        Parameters:
+            chars:                  Array from index to character.
+        '''
+
+        self.kernel = np.asarray(kernel, dtype=np.float32)
+        self.recurrent_kernel = np.asarray(recurrent_kernel, dtype=np.float32)
+        self.bias = np.asarray(bias, dtype=np.float32)
+        self.dense_kernel = np.asarray(dense_kernel, dtype=np.float32)
+        self.dense_bias = np.asarray(dense_bias, dtype=np.float32)
+        self.H = len(self.recurrent_kernel)
+
+        self.mapping = mapping
+        self.chars = np.empty(len(mapping), dtype='<U1')
+        for char, i in mapping.items():
+            self.chars[i] = char
+
+        if recurrent_activation == 'sigmoid':
+            self._gate = _sigmoid
+        elif recurrent_activation == 'hard_sigmoid':
+            self._gate = _hard_sigmoid
+        else:
+            raise ValueError('Unsupported recurrent activation %r.'
+                             % recurrent_activation)
+
+    @classmethod
+    def from_keras(cls, model, mapping):
+        '''
+        Builds a decoder from a trained model such as the one of
+        RNN_generation.ipynb.
+
+        Arguments:
+            model:      A Keras model, or the path of a saved one.
+
+            mapping:    Dictionary from character to index, or the path of
+                        its pickle.
+        '''
+
+        if isinstance(model, str):
+            from keras.models import load_model
+            model = load_model(model)
+
+        if isinstance(mapping, str):
+            with open(mapping, 'rb') as f:
+                mapping = pickle.load(f)
+
+        lstm = [layer for layer in model.layers
+                if type(layer).__name__ == 'LSTM'][0]
+        dense = [layer for layer in model.layers
+                 if type(layer).__name__ == 'Dense'][-1]
+
+        kernel, recurrent_kernel, bias = lstm.get_weights()
+        dense_kernel, dense_bias = dense.get_weights()
+        activation = lstm.get_config()['recurrent_activation']
+
+        return cls(kernel, recurrent_kernel, bias, dense_kernel, dense_bias,
+                   mapping, activation)
+
+    def initial_state(self, B):
+        '''
+        Returns the zero hidden and cell states of B lines.
+        '''
+
+        return (np.zeros((B, self.H), dtype=np.float32),
+                np.zeros((B, self.H), dtype=np.float32))
+
+    def encode(self, text):
+        try:
+            return [self.mapping[char] for char in text]
+        except KeyError as error:
+            raise ValueError('Character %r is not in the mapping.'
+                             % error.args[0])
+
+    def step(self, state, idx, active=None):
+        '''
+        Advances the LSTM by one character per line.
+
+        Arguments:
+            state:      Tuple of hidden and cell states, of shape (B, H).
+
+            idx:        Integer array of the B input characters.
+
+            active:     Optional boolean array; inactive lines keep their
+                        state.
+
+        Returns:
+            state:      The new state.
+
+            logits:     Array of shape (B, V) of output logits.
+        '''
+
+        h, c = state
+        H = self.H
+
+        z = self.kernel[idx] + h.dot(self.recurrent_kernel) + self.bias
+
+        # Keras orders the gates input, forget, cell, output.
+        i = self._gate(z[:, :H])
+        f = self._gate(z[:, H:2 * H])
+        g = np.tanh(z[:, 2 * H:3 * H])
+        o = self._gate(z[:, 3 * H:])
+
+        c_new = f * c + i * g
+        h_new = o * np.tanh(c_new)
+
+        if active is not None:
+            c_new = np.where(active[:, None], c_new, c)
+            h_new = np.where(active[:, None], h_new, h)
+
+        return (h_new, c_new), h_new.dot(self.dense_kernel) + self.dense_bias
+
+    def prime(self, texts):
+        '''
+        Runs the LSTM over the texts, which may have different lengths, as
+        one batch. Shorter texts are aligned to the end and skip the steps
+        before they start.
+
+        Returns:
+            state:      State after the last character of every text.
+
+            logits:     Logits of the character following every text.
+        '''
+
+        encoded = [self.encode(text) for text in texts]
+        B = len(encoded)
+        T = max(len(x) for x in encoded)
+
+        if min(len(x) for x in encoded) == 0:
+            raise ValueError('Every seed needs at least one character.')
+
+        idx = np.zeros((B, T), dtype=int)
+        start = np.array([T - len(x) for x in encoded])
+        for b, x in enumerate(encoded):
+            idx[b, start[b]:] = x
+
+        state = self.initial_state(B)
+
+        for t in range(T):
+            state, logits = self.step(state, idx[:, t], start <= t)
+
+        return state, logits
+
+    def generate(self, seeds, n_chars, temperature=1., rng=None, window=None):
+        '''
+        Continues every seed text by n_chars characters, all seeds as one
+        batch.
+
+        Arguments:
+            seeds:          List of seed texts.
+
+            n_chars:        Number of characters to generate per seed.
+
+            temperature:    Divides the logits before the softmax. Lower
+                            values are more conservative; 0 always picks
+                            the most likely character, like predict_classes.
+
+            rng:            A numpy Generator, or a seed for one.
+
+            window:         Optional context length. Every window steps the
+                            state is rebuilt from the last window characters
+                            of each text, as the model saw during training.
+
+        Returns:
+            texts:          List of the seeds followed by their
+                            continuations.
+        '''
+
+        rng = np.random.default_rng(rng)
+        texts = list(seeds)
+
+        state, logits = self.prime(texts)
+        out = np.empty((len(texts), n_chars), dtype=int)
+
+        for t in range(n_chars):
+            idx = self.sample(logits, temperature, rng)
+            out[:, t] = idx
+
+            if window is not None and (t + 1) % window == 0:
+                recent = [(text + ''.join(self.chars[out[b, :t + 1]]))[-window:]
+                          for b, text in enumerate(texts)]
+                state, logits = self.prime(recent)
+            else:
+                state, logits = self.step(state, idx)
+
+        return [text + ''.join(self.chars[row]) for text, row in zip(texts, out)]
+
+    def sample(self, logits, temperature=1., rng=None):
+        '''
+        Draws one character index per row of logits from the softmax of
+        logits / temperature.
+        '''
+
+        if temperature == 0:
+            return logits.argmax(axis=1)
+
+        rng = np.random.default_rng(rng)
+
+        z = logits / temperature
+        p = np.exp(z - z.max(axis=1, keepdims=True))
+        cum = np.cumsum(p, axis=1)
+
+        u = rng.random(len(cum)) * cum[:, -1]
+        idx = (cum <= u[:, None]).sum(axis=1)
+
+        return np.minimum(idx, cum.shape[1] - 1)
+
+
+def _sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+
+def _hard_sigmoid(x):
+    # The Keras 2 definition.
+    return np.clip(0.2 * x + 0.5, 0., 1.)